@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmarks of the hot spots of the parser.
+
+    python bench.py            # run all
+    python bench.py sanitize   # run one
+'''
+import os
+import sys
+import string
+import random
+import tempfile
+import subprocess
+from time import time
+import utils
+import pdfcheck
+
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def timed(fn, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t1 = time()
+        fn(*args)
+        elapsed = time() - t1
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def sample_text(size, seed=0):
+    '''size chars of text with some accents, symbols and control chars'''
+    rnd = random.Random(seed)
+    extra = 'áéíóú€£–’“”\x00\x07\x1b'
+    alphabet = string.printable + extra
+    weights = [50] * len(string.printable) + [1] * len(extra)
+    return ''.join(rnd.choices(alphabet, weights, k=size))
+
+
+def _remove_non_printable_chars_filter(text):
+    # implementation previous to the translate table
+    return ''.join(list(filter(lambda x: x in set(string.printable), text)))
+
+
+@benchmark
+def sanitize(size=10 * 1024 * 1024):
+    text = sample_text(size)
+    mb = len(text.encode('utf-8')) / 1024 / 1024
+
+    assert (_remove_non_printable_chars_filter(text) ==
+            utils.remove_non_printable_chars(text))
+
+    before = timed(_remove_non_printable_chars_filter, text, repeat=1)
+    after = timed(utils.remove_non_printable_chars, text)
+    print('remove_non_printable_chars ({:.1f} MB)'.format(mb))
+    print('  filter + set:      {:8.1f} MB/s'.format(mb / before))
+    print('  translate table:   {:8.1f} MB/s'.format(mb / after))
+
+
+@benchmark
+def clean(nlines=20000):
+    import cleaner
+    # the previous loop and the corpus of the equivalence tests
+    from test_cleaner import _clean_lines_old, sample_lines, EXCLUDE
+    lines = [line for line in sample_lines(nlines, random.Random(1))
+             if 'Disclosure' not in line]
+    exclude_re = cleaner.compile_exclude_words(EXCLUDE)
+    before = timed(_clean_lines_old, lines, 20, EXCLUDE, repeat=1)
+    after = timed(cleaner.clean_lines, lines, 20, exclude_re)
+    print('clean_lines ({} lines)'.format(nlines))
+    print('  per line loop:     {:8.3f} secs'.format(before))
+    print('  clean_lines:       {:8.3f} secs'.format(after))
+
+
+def _check_eof_tail(pdf_path):
+    # check previous to pdfcheck: a tail subprocess per file
+    eof = subprocess.check_output(['tail', '-n', '1', pdf_path])
+    eof = eof.replace(b'\r', b'').replace(b'\n', b'')
+    return b'%%EOF' in eof[-5:]
+
+
+@benchmark
+def eof_check(nfiles=10000):
+    body = (b'%PDF-1.4\n1 0 obj\n<< /Type /Catalog >>\nendobj\n' +
+            b'x' * 20000 + b'\n')
+    xref = len(body)
+    body += (b'xref\n0 1\n0000000000 65535 f \ntrailer\n<< /Size 1 >>\n' +
+             b'startxref\n' + str(xref).encode() + b'\n%%EOF\n')
+
+    with tempfile.TemporaryDirectory() as tmppath:
+        paths = []
+        for i in range(nfiles):
+            path = os.path.join(tmppath, '{}.pdf'.format(i))
+            with open(path, 'wb') as f:
+                f.write(body)
+            paths.append(path)
+
+        def run_tail():
+            for path in paths:
+                _check_eof_tail(path)
+
+        def run_pdfcheck():
+            for path in paths:
+                pdfcheck.check_pdf(path)
+
+        before = timed(run_tail, repeat=1)
+        after = timed(run_pdfcheck)
+
+    print('EOF check ({} files)'.format(nfiles))
+    print('  tail subprocess:   {:8.1f} files/s'.format(nfiles / before))
+    print('  pdfcheck (mmap):   {:8.1f} files/s'.format(nfiles / after))
+
+
+def sample_document(nwords, seed=0):
+    '''nwords of english-like text in sentences of 3 to 35 words'''
+    rnd = random.Random(seed)
+    vocab = ['market', 'markets', 'growth', 'growing', 'revenue', 'revenues',
+             'the', 'of', 'and', 'a', 'to', 'in', 'is', 'we', 'expect',
+             'expected', 'margin', 'margins', 'earnings', 'quarter',
+             'guidance', 'increase', 'increased', 'decline', 'declining',
+             'rating', 'price', 'target', 'shares', 'company', 'strong',
+             'weak', 'demand', 'supply', 'costs', '2019', 'eps', 'ebitda']
+    vocab += [''.join(rnd.choice(string.ascii_lowercase) for _ in range(8))
+              for _ in range(2000)]
+    sentences = []
+    total = 0
+    while total < nwords:
+        n = rnd.randint(3, 35)
+        words = [rnd.choice(vocab) for _ in range(n)]
+        sentences.append(' '.join(words).capitalize() + '.')
+        total += n
+    return ' '.join(sentences)
+
+
+def _score_sentences_old(text):
+    # scoring previous to text_summary.score_sentences
+    import nltk
+    from text_summary import nltk_resources
+    tokenizer = nltk_resources()['tokenizer']
+    stemmer = nltk_resources()['stemmer']
+    stopwords = list(nltk_resources()['stopwords'])
+    sent_tokenize = nltk_resources()['sent_tokenize']
+    tokens = nltk.Text(tokenizer.tokenize(text))
+    tokens = [w.lower() for w in tokens if w.isalpha() and not w.isdigit()]
+    tokens = [stemmer.stem(w) for w in tokens if w not in stopwords]
+    tokens_frequencies = dict(nltk.FreqDist(tokens))
+    tokens_frequencies = dict(sorted(tokens_frequencies.items(), key=lambda kv: kv[1], reverse=True))
+    sentences = sent_tokenize(text)
+    sentence_scores = dict((sent,0) for sent in sentences)
+    for sent in sentences:
+        if len(sent.split()) <= 30 and len(sent.split()) >= 4:
+            words = tokenizer.tokenize(sent)
+            words = [stemmer.stem(w.lower()) for w in words if w.isalpha() and not w.isdigit()]
+            for word in words:
+                sentence_scores[sent] += tokens_frequencies.get(word, 0)
+    return sentences, sentence_scores, tokens_frequencies
+
+
+@benchmark
+def summary(nwords=100000):
+    import text_summary
+    text = sample_document(nwords)
+
+    assert _score_sentences_old(text) == text_summary.score_sentences(text)
+
+    before = timed(_score_sentences_old, text)
+    text_summary.stem.cache_clear()
+    cold = timed(text_summary.score_sentences, text, repeat=1)
+    warm = timed(text_summary.score_sentences, text)
+    vector = timed(text_summary.best_sentences, text, 20, 'tf')
+    print('text_summary sentence scoring ({} words)'.format(nwords))
+    print('  previous:            {:8.3f} secs'.format(before))
+    print('  single pass (cold):  {:8.3f} secs'.format(cold))
+    print('  single pass (warm):  {:8.3f} secs'.format(warm))
+    print('  numpy (warm):        {:8.3f} secs'.format(vector))
+
+
+@benchmark
+def importtime(module='parser', top=10):
+    '''What a spawned worker pays before its first task'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import {}'.format(module)],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    total, modules = 0, []
+    for line in proc.stderr.decode('utf-8', 'ignore').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative)
+        elif depth == 1:    # imported by the module itself
+            modules.append((int(cumulative), name.strip()))
+
+    if proc.returncode != 0:
+        print(proc.stderr.decode('utf-8', 'ignore').splitlines()[-1])
+    print("import {} (python -X importtime)".format(module))
+    print('  total:               {:8.3f} secs'.
+          format(total / 1e6))
+    for us, name in sorted(modules, reverse=True)[:top]:
+        print('  {:20} {:8.3f} secs'.format(name, us / 1e6))
+
+
+@benchmark
+def scan(nfiles=100000, per_dir=500):
+    '''Files to process under dir_root, the full walk vs the state index'''
+    from scanner import FileState
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = os.path.join(tmpdir, 'root')
+        for i in range(nfiles):
+            folder = os.path.join(root, 'dir {}'.format(i // per_dir))
+            if i % per_dir == 0:
+                os.makedirs(folder)
+            with open(os.path.join(folder, 'doc {}.pdf'.format(i)), 'wb') as f:
+                f.write(b'%PDF-1.4')
+
+        def walk():
+            utils.replace_recursively(root)
+            return utils.files_in_dir_recursively(root, '.pdf')
+
+        state = FileState(os.path.join(tmpdir, 'files.db'))
+        files = list(state.scan(root, '.pdf'))
+        assert len(files) == nfiles
+        before = timed(walk)
+        with state.db:
+            state.db.execute('UPDATE files SET done = 1')
+        rescan = timed(lambda: list(state.scan(root, '.pdf')))
+
+        print('Scan of {} unchanged files'.format(nfiles))
+        print('  rename + walk:       {:8.3f} secs'.format(before))
+        print('  state index:         {:8.3f} secs'.format(rescan))
+
+
+@benchmark
+def thumbpack(ndocs=2000, pages=10, page_bytes=20000):
+    '''Page images as loose files vs one pack per document'''
+    import thumbpack as tp
+
+    rnd = random.Random(0)
+    image = os.urandom(page_bytes)
+    reads = [(rnd.randrange(ndocs), rnd.randint(1, pages))
+             for _ in range(ndocs * 5)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        loose = os.path.join(tmpdir, 'loose')
+        packed = os.path.join(tmpdir, 'packed')
+
+        def write_loose():
+            for doc in range(ndocs):
+                folder = os.path.join(loose, str(doc))
+                os.makedirs(folder, exist_ok=True)
+                for page in range(1, pages + 1):
+                    with open(os.path.join(folder, 'page-{:03d}.jpg'.
+                                           format(page)), 'wb') as f:
+                        f.write(image)
+
+        def write_packed():
+            for doc in range(ndocs):
+                folder = os.path.join(packed, str(doc))
+                os.makedirs(folder, exist_ok=True)
+                tp.write_pack(os.path.join(folder, tp.PACK_NAME),
+                              dict((page, image) for page in range(1, pages + 1)))
+
+        def read_loose():
+            for doc, page in reads:
+                with open(os.path.join(loose, str(doc), 'page-{:03d}.jpg'.
+                                       format(page)), 'rb') as f:
+                    f.read()
+
+        def read_packed():
+            for doc, page in reads:
+                tp.read_pack(os.path.join(packed, str(doc)), page)
+
+        w_loose = timed(write_loose, repeat=1)
+        w_packed = timed(write_packed, repeat=1)
+        r_loose = timed(read_loose)
+        r_packed = timed(read_packed)
+        count = lambda top: sum(len(files) for _, _, files in os.walk(top))
+
+        print('{} documents x {} pages'.format(ndocs, pages))
+        print('  loose:  {:7d} files  write {:6.3f} secs  {} reads {:6.3f} secs'.
+              format(count(loose), w_loose, len(reads), r_loose))
+        print('  packed: {:7d} files  write {:6.3f} secs  {} reads {:6.3f} secs'.
+              format(count(packed), w_packed, len(reads), r_packed))
+
+
+@benchmark
+def metrics_overhead(n=1000000):
+    '''Cost of recording a metric on the hot path'''
+    import metrics
+
+    registry = metrics.Registry()
+    hist = registry.register(metrics.Histogram('bench_seconds', 'bench', ('stage',)))
+    count = registry.register(metrics.Counter('bench_total', 'bench', ('stage',)))
+    child = hist.labels('parse')
+
+    def observe():
+        for i in range(n):
+            child.observe(0.001)
+
+    def observe_labels():
+        for i in range(n):
+            hist.observe(0.001, 'parse')
+
+    def timer():
+        for i in range(n):
+            with child.time():
+                pass
+
+    def inc():
+        for i in range(n):
+            count.inc('parse')
+
+    print('metrics, {} calls'.format(n))
+    for name, fn in (('observe (child)', observe),
+                     ('observe (labels)', observe_labels),
+                     ('time() block', timer),
+                     ('counter inc', inc)):
+        print('  {:20} {:8.3f} usecs/call'.format(name, timed(fn) / n * 1e6))
+
+
+def _log_fun_calls_old(fn, log):
+    '''control.logFunCalls before the tracing rewrite'''
+    import uuid
+    import functools
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        id = str(uuid.uuid4())[:8]
+        fname = fn.__name__
+        arg = '; '.join(str(arg) for arg in args)
+        log.info("in: '{fname}' ({id})  [ args: {arg} ]".
+                 format(fname=fname, id=id, arg=utils.cut_line(arg, 80)))
+        for key, value in kwargs.items():
+            log.info("in: '{fname}' ({id})  [ kwargs: {key}:{value} ]".
+                     format(fname=fname, id=id, key=utils.cut_line(key, 20),
+                            value=utils.cut_line(value, 80)))
+        t1 = time()
+        out = fn(*args, **kwargs)
+        log.info("out: '{fname}' ({id}) {tm} secs.".
+                 format(fname=fname, id=id, tm=round(time() - t1, 4)))
+        return out
+    return wrapper
+
+
+@benchmark
+def decorator(n=20000):
+    '''Per call cost of the call logging, logs written to a temp file'''
+    import logging
+    import control
+
+    doc = sample_document(2000)
+    record = {'meta': {'filename': 'doc', 'pages': 10.0}, 'content': doc}
+
+    def store_record(index, doc_name, body):
+        return True
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'bench.log')
+
+        sync_log = logging.getLogger('bench.sync')
+        sync_log.propagate = False
+        sync_handler = logging.FileHandler(path)
+        sync_handler.setFormatter(control.formatter)
+        sync_log.addHandler(sync_handler)
+
+        queued = control.monkey.get_original('queue', 'SimpleQueue')()
+        queue_handler = logging.FileHandler(path)
+        queue_handler.setFormatter(control.formatter)
+        writer = control._LogWriter(queued, queue_handler)
+        writer.start()
+        async_log = logging.getLogger('bench.queue')
+        async_log.propagate = False
+        async_log.addHandler(control._QueueHandler(queued))
+
+        variants = [
+            ('no decorator', store_record),
+            ('previous', _log_fun_calls_old(store_record, sync_log)),
+            ('trace', control.trace(store_record, 1.0, async_log)),
+            ('trace, 1% sampled', control.trace(store_record, 0.01, async_log)),
+            ('trace, DEBUG args', control.trace(store_record, 1.0, async_log))
+        ]
+
+        def calls(fn):
+            for _ in range(n):
+                fn('files', '_doc', record)
+
+        print('Call logging of store_record, {} calls ({} chars document)'.
+              format(n, len(doc)))
+        for name, fn in variants:
+            sync_log.setLevel(logging.INFO)
+            async_log.setLevel(logging.DEBUG if 'DEBUG' in name else logging.INFO)
+            print('  {:20} {:8.2f} usecs/call'.format(name, timed(calls, fn) / n * 1e6))
+
+        writer.stop()
+        sync_handler.close()
+        queue_handler.close()
+
+
+if __name__ == '__main__':
+
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark '{}'. Valid: {}".
+                  format(name, ', '.join(BENCHMARKS)))
+            sys.exit(1)
+        BENCHMARKS[name]()
+    sys.exit(0)
@@ -0,0 +1,117 @@
+import os
+import gzip
+import json
+from time import time
+import utils
+from control import logger
+
+
+def encode_json(value):
+    return gzip.compress(json.dumps(value).encode('utf-8'))
+
+
+def decode_json(data):
+    '''None when data is not a valid entry'''
+    try:
+        return json.loads(gzip.decompress(data).decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+
+
+class DiskCache():
+    '''
+    Content addressed cache of files under `directory`, bounded to
+    max_bytes. Reading an entry refreshes its mtime; when the cache grows
+    over max_bytes the least recently used entries are removed until it
+    is back under 90% of the limit.
+    '''
+
+    def __init__(self, directory, max_bytes, suffix=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.entries = {}   # key -> [size, last use]
+        self.size = 0
+        utils.create_directory(directory)
+        self._load()
+
+    def _load(self):
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if not entry.name.endswith(self.suffix) or entry.name.startswith('.'):
+                    continue
+                key = entry.name[:len(entry.name) - len(self.suffix)]
+                st = entry.stat()
+                self.entries[key] = [st.st_size, st.st_mtime]
+                self.size += st.st_size
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            self._forget(key)
+            return None
+        self.entries[key][1] = time()
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        utils.create_directory(os.path.dirname(path))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)   # readers never see a partial entry
+
+        self._forget(key)
+        self.entries[key] = [len(data), time()]
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict(int(self.max_bytes * 0.9))
+
+    def get_json(self, key):
+        data = self.get(key)
+        if data is None:
+            return None
+        value = decode_json(data)
+        if value is None:
+            self.delete(key)
+        return value
+
+    def put_json(self, key, value):
+        self.put(key, encode_json(value))
+
+    def _forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry[0]
+
+    def delete(self, key):
+        self._forget(key)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self, target):
+        lru = sorted(self.entries.items(), key=lambda kv: kv[1][1])
+        removed = 0
+        for key, _ in lru:
+            if self.size <= target:
+                break
+            self.delete(key)
+            removed += 1
+        logger.info("Cache '{}': {} entries evicted, {} bytes used".
+                    format(self.directory, removed, self.size))
@@ -0,0 +1,161 @@
+import os
+import re
+import tempfile
+from collections import Counter
+from config import config
+import utils
+
+
+re_spaces = re.compile(r'\s+')
+
+
+def compile_exclude_words(words):
+    '''
+    Single pattern matching a line if any r'\b<word>\b' matches it.
+    Every word is kept as its own group, so the result is the same as
+    searching the words one by one.
+    '''
+    if not words:
+        return None
+    return re.compile('|'.join(
+        r'(?:\b' + w.lower().replace('+', r'\+') + r'\b)' for w in words))
+
+
+class ExcludeWords():
+    '''
+    Exclude words list compiled into one pattern. The file is read again
+    only when its mtime changes, so edits are picked up without restarting
+    the workers.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.words = []
+        self.mtime = None
+        self._pattern = None
+        self._loaded = False
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        if self._loaded and mtime == self.mtime:
+            return
+
+        self.words = utils.read_txt_file(self.path) if mtime is not None else []
+        self._pattern = compile_exclude_words(self.words)
+        self.mtime = mtime
+        self._loaded = True
+
+    @property
+    def pattern(self):
+        self._reload()
+        return self._pattern
+
+
+_exclude_words = None
+
+
+def get_exclude_words():
+    '''Process wide ExcludeWords for config['app']['exclude_words']'''
+    global _exclude_words
+    if _exclude_words is None:
+        path = config['app'].get('exclude_words', './exclude_words.txt')
+        _exclude_words = ExcludeWords(path)
+    return _exclude_words
+
+
+class LineCleaner():
+    '''
+    Line by line state of clean_lines. feed() returns the text to append
+    for a line ('' for nothing) and sets `done` at the 'disclosure' line.
+    counts[key(line)] is the number of times the line is in the document.
+    '''
+
+    def __init__(self, counts, numpages, exclude_re=None, key=None):
+        self.counts = counts
+        self.key = key
+        self.max_repeat = max(numpages - 10, 4)
+        self.exclude_re = exclude_re
+        self.tail = ''      # last two chars written
+        self.done = False
+
+    def feed(self, line):
+        if not line and self.tail != '\n\n':
+            self.tail = self.tail[-1:] + '\n'
+            return '\n'
+
+        lower = line.lower()
+        if 'disclosure' in lower:
+            self.done = True
+            return ''
+        if self.exclude_re is not None and ('@' in line or
+                                            self.exclude_re.search(lower)):
+            return ''
+
+        count = self.counts[self.key(line) if self.key else line]
+        if count <= self.max_repeat:
+            #remove extra spaces
+            clean_line = utils.remove_nonsense_lines(re_spaces.sub(' ', line), 6)
+            if clean_line:
+                self.tail = (clean_line + '\n')[-2:]
+                return clean_line + '\n'
+        return ''
+
+
+def clean_lines(lines, numpages, exclude_re=None):
+    '''
+    Remove from the lines of a document:
+        - everything after the first line mentioning 'disclosure'
+        - lines with an '@' or an excluded word (when exclude_re is given)
+        - lines repeated more than max(numpages-10, 4) times (headers,
+          footers)
+        - lines with less than 6 printable chars
+    and collapse runs of empty lines. Returns the clean text.
+    '''
+
+    line_cleaner = LineCleaner(Counter(lines), numpages, exclude_re)
+    out = []
+    for line in lines:
+        piece = line_cleaner.feed(line)
+        if line_cleaner.done:
+            break
+        out.append(piece)
+    return ''.join(out)
+
+
+def iter_lines(pieces):
+    '''Lines of ''.join(pieces), as str.split('\n') would return them'''
+    rest = ''
+    for piece in pieces:
+        lines = (rest + piece).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    yield rest
+
+
+def clean_stream(pieces, numpages, exclude_re=None):
+    '''
+    Same result as clean_lines(''.join(pieces).split('\n'), ...), yielded
+    in pieces, without holding the document in memory: a first pass spools
+    the lines to a temporary file and counts them by hash, the second pass
+    cleans them from the file.
+    '''
+
+    counts = Counter()
+    with tempfile.TemporaryFile() as spool:
+        for line in iter_lines(pieces):
+            counts[hash(line)] += 1
+            spool.write(line.encode('utf-8') + b'\n')
+        spool.seek(0)
+
+        line_cleaner = LineCleaner(counts, numpages, exclude_re, key=hash)
+        for raw in spool:
+            piece = line_cleaner.feed(raw[:-1].decode('utf-8'))
+            if line_cleaner.done:
+                break
+            if piece:
+                yield piece
@@ -12,11 +12,113 @@ config = {
         'dir_errors': '../../pms/repository/errors',
         'ignore_same_docs': True,
         'freq_min': 5,
-        'logfile': log_path
+        'logfile': log_path,
+        'exclude_words': './exclude_words.txt'
     },
 
     'elasticsearch': {
         'host': '127.0.0.1',
         'port': 9200,
+        'pool_size': 10,            # http connections kept open
+        'health_check_secs': 10,    # background ping, 0 to disable
+        'retry_secs': 5,            # when down, ping on demand at most this often
+        'bulk_size': 500,           # max docs per _bulk request
+        'bulk_bytes': 10485760,     # max bytes per _bulk request
+        'bulk_retries': 3           # retries of rejected items
+    },
+
+    'parser': {
+        'extractor': 'auto',        # mupdf | textract | auto
+        'strict_xref': False,       # a bad startxref offset is an error
+        'stream_pages': 500         # stream documents with more pages
+    },
+
+    'summary': {
+        'scoring': 'tf',            # loop | tf (numpy) | tfidf (numpy)
+        'idf_path': os.path.join(dir_path, 'idf.db')
+    },
+
+    'sentiment': {
+        'backend': 'vader',         # vader (in process) | http
+        'url': 'http://text-processing.com/api/sentiment/',
+        'timeout': 5,               # secs, http backend
+        'pool_size': 20             # connections, http backend
+    },
+
+    'executor': {
+        'backend': 'process',       # process | thread | gevent
+        'workers': None,            # None: one per core
+        'task_timeout': 600,        # secs per parse_pdf call
+        'start_method': 'spawn'
+    },
+
+    'dedupe': {
+        'index_path': os.path.join(dir_path, 'hashes.db'),
+        'warm_on_start': True       # reload the local index from ES
+    },
+
+    'base64': {                     # copy of the content in base64
+        'mode': 'off',              # off | index | disk (side store)
+        'dir': os.path.join(dir_path, '.sidestore')
+    },
+
+    'scanner': {                    # files seen under dir_root
+        'state_path': os.path.join(dir_path, 'files.db'),
+        'rename': True              # normalise the names of new files
+    },
+
+    'watch': {                      # inotify on dir_root (linux)
+        'enabled': False,           # freq_min becomes the sweep interval
+        'settle_secs': 2,           # quiet time before a file is queued
+        'inflight_secs': 3600       # queue a file again after n secs
+    },
+
+    'thumbnails': {                 # page images in dir_processed/images
+        'mode': 'eager',            # eager | lazy (rest on request)
+        'pages': 10,                # first n pages of every document
+        'ingest_pages': 1,          # pages rendered at ingest when lazy
+        'dpi': 80,
+        'format': 'jpeg',           # jpeg | webp
+        'storage': 'files',         # files | pack (one file per document)
+        'quality': 75,
+        'workers': 4,               # pdftoppm processes at a time
+        'index_path': os.path.join(dir_path, 'thumbnails.db'),
+        'cache_dir': os.path.join(dir_path, '.cache', 'pages'),
+        'cache_bytes': 1024 ** 3,   # pages rendered on request
+        'server_host': '127.0.0.1',
+        'server_port': 8090
+    },
+
+    'cache': {                      # parse_pdf results by raw file hash
+        'enabled': True,
+        'dir': os.path.join(dir_path, '.cache', 'parse'),
+        'max_bytes': 2 * 1024 ** 3
+    },
+
+    'trace': {                      # decfun call logging
+        'enabled': True,
+        'sample': 1.0               # share of the calls logged
+    },
+
+    'metrics': {                    # prometheus text format on /metrics
+        'enabled': True,
+        'host': '127.0.0.1',
+        'port': 9108
+    },
+
+    'pipeline': {
+        'queue_size': 50,           # max items waiting in front of a stage
+        'status_secs': 10,          # log stage counters every n secs
+        'dedupe_batch': 50,         # hashes checked per request
+        'dedupe_flush_secs': 1,
+        'index_batch': 100,         # docs per bulk flush
+        'index_flush_secs': 2,      # flush a partial batch after n secs
+        'workers': {                # greenlets per stage (parse uses executor)
+            'prehash': 2,
+            'dedupe': 1,
+            'thumbnails': 2,
+            'index': 2,
+            'move': 1
+        }
     }
 }
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules import each other by name, as when run from src
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -1,17 +1,22 @@
 from gevent import monkey
 monkey.patch_all()
 import gevent
+import os
 import sys
 import uuid
+import atexit
+import reprlib
 import logging
-from time import time
+import itertools
+import functools
+from logging.handlers import QueueHandler, QueueListener
+from time import perf_counter
 from config import config
-import utils
 
 ###################################
 # CONTROL
 
-DECORATOR = True
+DECORATOR = config.get('trace', {}).get('enabled', True)
 LOGGERNAME = config['app']['app_name']
 
 ###################################
@@ -24,6 +29,43 @@ formatter = logging.Formatter(
     '[%(filename)s:%(lineno)d] #  %(message)s'),
     '%Y-%m-%d:%H:%M:%S')
 
+
+class _QueueHandler(QueueHandler):
+    '''Only merges the message args; the formatting (time, location)
+    and the writes happen in the writer thread'''
+
+    def prepare(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class _LogWriter(QueueListener):
+    '''
+    Writes the queued records from a real OS thread (monkey.patch_all
+    turns threading.Thread into a greenlet, which would write from the
+    hub), so logging never blocks the caller on disk or stdout.
+    '''
+
+    def start(self):
+        self._done = monkey.get_original('_thread', 'allocate_lock')()
+        self._done.acquire()
+        monkey.get_original('_thread', 'start_new_thread')(self._run, ())
+
+    def _run(self):
+        try:
+            self._monitor()
+        finally:
+            self._done.release()
+
+    def stop(self, timeout=5):
+        if self._done is not None:
+            self.enqueue_sentinel()
+            self._done.acquire(timeout=timeout)
+            self._done = None
+
+
 logger = logging.getLogger(LOGGERNAME)
 logger.setLevel(loglevel)
 logger.propagate = False
@@ -36,39 +78,97 @@ fHandler = logging.FileHandler(logfile_path, encoding='utf-8') #, mode='w')
 fHandler.setLevel(loglevel)
 fHandler.setFormatter(formatter)
 
-logger.addHandler(sHandler)
-logger.addHandler(fHandler)
 
+def _start_log_writer():
+    global log_queue, log_writer
+    log_queue = monkey.get_original('queue', 'SimpleQueue')()
+    log_writer = _LogWriter(log_queue, sHandler, fHandler,
+                            respect_handler_level=True)
+    log_writer.start()
+    queue_handler.queue = log_queue
+
+
+def _stop_log_writer():
+    log_writer.stop()
+
+
+def _after_fork_in_child():
+    # a forked child (executor start_method 'fork') gets the queue but
+    # not the writer thread: records would pile up and never be written.
+    # It gets its own, stopped by the multiprocessing exit handlers too,
+    # as pool workers leave with os._exit and skip atexit.
+    from multiprocessing.util import Finalize
+    _start_log_writer()
+    Finalize(None, _stop_log_writer, exitpriority=0)
 
-def logFunCalls(fn):
+
+# records are queued by the caller and written by a background thread
+queue_handler = _QueueHandler(None)
+_start_log_writer()
+atexit.register(_stop_log_writer)
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+logger.addHandler(queue_handler)
+
+
+# bounded repr of the arguments, a document dict is not stringified whole
+_arg_repr = reprlib.Repr()
+_arg_repr.maxstring = 80
+_arg_repr.maxother = 80
+_arg_repr.maxdict = 6
+_arg_repr.maxlist = 6
+_arg_repr.maxlevel = 2
+
+
+def _format_args(args, kwargs):
+    parts = [_arg_repr.repr(arg) for arg in args]
+    parts.extend('{}={}'.format(key, _arg_repr.repr(value))
+                 for key, value in kwargs.items())
+    return '; '.join(parts)
+
+
+def trace(fn=None, sample=None, log=None, name=None):
+    '''
+    Log the calls of fn: entry and exit (with the elapsed time) at INFO,
+    the arguments only at DEBUG. With sample < 1 one call in
+    round(1 / sample) is logged and the others only pay a counter
+    increment. On a class, its constructor calls are logged.
+    Defaults to config['trace']['sample'].
+    '''
+    if fn is None:
+        return functools.partial(trace, sample=sample, log=log, name=name)
+
+    if isinstance(fn, type):
+        fn.__init__ = trace(fn.__init__, sample, log, name or fn.__name__)
+        return fn
+
+    if sample is None:
+        sample = config.get('trace', {}).get('sample', 1.0)
+    every = max(int(round(1 / sample)), 1) if sample > 0 else 0
+    log = log or logger
+    fname = name or fn.__name__
+    calls = itertools.count(1)     # call id, paired in/out lines
+
+    @functools.wraps(fn)
     def wrapper(*args, **kwargs):
-        id = str(uuid.uuid4())[:8]
-        fname = fn.__name__
-        logger = logging.getLogger(LOGGERNAME)
-
-        arg = '; '.join(str(arg) for arg in args)
-        logger.info("in: '{fname}' ({id})  [ args: {arg} ]".
-                    format(fname=fname, id=id,
-                           arg=utils.cut_line(arg, 80)))
-        for key, value in kwargs.items():
-            logger.info("in: '{fname}' ({id})  [ kwargs: {key}:{value} ]".
-                        format(fname=fname, id=id,
-                               key=utils.cut_line(key, 20),
-                               value=utils.cut_line(value, 80)))
-
-        t1 = time()
+        n = next(calls)
+        if not every or n % every or not log.isEnabledFor(logging.INFO):
+            return fn(*args, **kwargs)
+
+        log.info("in: '%s' (%d)", fname, n)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("in: '%s' (%d)  [ args: %s ]", fname, n,
+                      _format_args(args, kwargs))
+        t1 = perf_counter()
         out = fn(*args, **kwargs)
-
-        logger.info("out: '{fname}' ({id}) {tm} secs.".
-                    format(fname=fname, id=id, tm=round(time()-t1, 4)))
-        # Return the return value
+        log.info("out: '%s' (%d) %.4f secs.", fname, n, perf_counter() - t1)
         return out
     return wrapper
 
 
 def decfun(f):
     if DECORATOR:
-        return logFunCalls(f)
+        return trace(f)
     else:
         return f
 
@@ -0,0 +1,136 @@
+from gevent import monkey
+monkey.patch_all()
+import json
+import sqlite3
+from config import config
+from control import logger
+
+
+HASH_FIELD = 'meta.content_sha512_hex'
+
+
+def terms_query(field, values):
+    '''Nested terms query on the meta field returning only the hashes'''
+    return json.dumps({
+        'query': {
+            'nested': {
+                'path': field.split('.')[0],
+                'query': {'terms': {field: values}}
+            }
+        },
+        '_source': [field],
+        'size': min(len(values) * 10, 10000)
+    })
+
+
+class HashIndex():
+    '''
+    Content hashes of the documents already stored in Elasticsearch, kept
+    in a local SQLite file so most duplicate checks never leave the box.
+    Only hashes confirmed by Elasticsearch are added.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS content '
+                        '(hash TEXT PRIMARY KEY)')
+        # raw file (sha256, size) -> content hash of its parsed text
+        self.db.execute('CREATE TABLE IF NOT EXISTS raw_files '
+                        '(raw_hash TEXT, size INTEGER, content_hash TEXT, '
+                        'PRIMARY KEY (raw_hash, size))')
+        self.db.commit()
+
+    def known(self, hashes):
+        '''Subset of hashes already in the index'''
+        found = set()
+        hashes = list(hashes)
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            rows = self.db.execute(
+                'SELECT hash FROM content WHERE hash IN ({})'.
+                format(','.join('?' * len(chunk))), chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def add(self, hashes):
+        self.db.executemany('INSERT OR IGNORE INTO content VALUES (?)',
+                            [(h,) for h in hashes])
+        self.db.commit()
+
+    def add_raw(self, items):
+        '''items: (raw_hash, size, content_hash)'''
+        self.db.executemany('INSERT OR REPLACE INTO raw_files VALUES (?, ?, ?)',
+                            list(items))
+        self.db.commit()
+
+    def known_raw(self, raw_hash, size):
+        '''Content hash of an already stored file with these raw bytes'''
+        row = self.db.execute(
+            'SELECT r.content_hash FROM raw_files r JOIN content c '
+            'ON c.hash = r.content_hash WHERE r.raw_hash = ? AND r.size = ?',
+            (raw_hash, size)).fetchone()
+        return row[0] if row else None
+
+    def clear(self):
+        self.db.execute('DELETE FROM content')
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM content').fetchone()[0]
+
+    def warm(self, es, index_name='files'):
+        '''Rebuild the index from the hashes stored in Elasticsearch'''
+        self.clear()
+        batch = []
+        query = {'query': {'match_all': {}}, '_source': [HASH_FIELD]}
+        for hit in es.scan(index_name, query):
+            meta = hit.get('_source', {}).get('meta', {})
+            value = meta.get('content_sha512_hex') if isinstance(meta, dict) else None
+            if value:
+                batch.append(value)
+            if len(batch) >= 10000:
+                self.add(batch)
+                batch = []
+        self.add(batch)
+        logger.info("Hash index warmed with {} documents of '{}'".
+                    format(len(self), index_name))
+
+    def lookup(self, es, hashes, index_name='files'):
+        '''
+        Subset of hashes already stored: the local index first, then one
+        terms query to Elasticsearch for the rest. When Elasticsearch can
+        not answer, only the local index is used.
+        '''
+        hashes = set(hashes)
+        found = self.known(hashes)
+        missing = list(hashes - found)
+        if missing:
+            try:
+                res = es.search(index_name, terms_query(HASH_FIELD, missing))
+            except Exception as ex:
+                logger.error('Error looking up hashes: {}'.format(str(ex)))
+                res = None
+            if res is None:
+                logger.error('Elasticsearch not available, {} documents '
+                             'checked against the local index only'.
+                             format(len(missing)))
+                return found
+            stored = set()
+            for hit in res['hits']['hits']:
+                meta = hit.get('_source', {}).get('meta', {})
+                stored.add(meta.get('content_sha512_hex'))
+            stored &= set(missing)
+            self.add(stored)
+            found |= stored
+        return found
+
+
+_hash_index = None
+
+
+def get_hash_index():
+    global _hash_index
+    if _hash_index is None:
+        _hash_index = HashIndex(config['dedupe']['index_path'])
+    return _hash_index
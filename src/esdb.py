@@ -3,25 +3,112 @@ monkey.patch_all()
 import gevent
 from time import time
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
+from elasticsearch.exceptions import TransportError
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
 from elasticsearch.client.ingest import IngestClient
 import utils
+from config import config
 from control import logger, decfun
 
 
+# per item statuses worth sending again (rejected execution, unavailable)
+BULK_RETRY_STATUS = (429, 502, 503, 504)
+
+
+class SharedClient():
+    '''
+    One pooled Elasticsearch client per host:port for the whole process.
+    Health is tracked from the requests themselves (a connection error
+    marks the node down, a successful request marks it up) and by a
+    background greenlet pinging every health_check_secs. A node marked
+    down is also pinged on demand, at most every retry_secs, so it comes
+    back without the background check too.
+    '''
+
+    def __init__(self, host, port, pool_size=10, health_check_secs=10,
+                 retry_secs=5):
+        self.host = host
+        self.port = port
+        self.retry_secs = retry_secs
+        self.es = Elasticsearch([{'host': host, 'port': port}],
+                                maxsize=pool_size)
+        self.checked = 0
+        self.healthy = self.ping()
+        self._checker = None
+        if health_check_secs:
+            self._checker = gevent.spawn(self._health_check, health_check_secs)
+
+    def ping(self):
+        self.checked = time()
+        try:
+            return bool(self.es.ping())
+        except Exception:
+            return False
+
+    def mark(self, healthy):
+        if healthy != self.healthy:
+            if healthy:
+                logger.info('Elasticsearch on {}:{} is back'.
+                            format(self.host, self.port))
+            else:
+                logger.error('Elasticsearch on {}:{} is down'.
+                             format(self.host, self.port))
+        self.healthy = healthy
+
+    def available(self):
+        '''Healthy, or back after the last retry_secs'''
+        if not self.healthy and time() - self.checked >= self.retry_secs:
+            self.mark(self.ping())
+        return self.healthy
+
+    def _health_check(self, secs):
+        while True:
+            gevent.sleep(secs)
+            self.mark(self.ping())
+
+
+_clients = {}
+
+
+def get_client(host, port):
+    key = (host, port)
+    if key not in _clients:
+        conf = config.get('elasticsearch', {})
+        _clients[key] = SharedClient(
+            host, port,
+            pool_size=conf.get('pool_size', 10),
+            health_check_secs=conf.get('health_check_secs', 10),
+            retry_secs=conf.get('retry_secs', 5))
+    return _clients[key]
+
+
 @decfun
 class ES():
     
     def __init__(self, host='127.0.0.1', port=9200):
 
         self.es = None
+        self.client = None
         self.host = host
         self.port = port
 
     def is_connected(self):
-        return True if self.es and self.es.ping() else False
+        return True if self.client and self.client.available() else False
+
+    def _request(self, fn, *args, **kwargs):
+        '''Call the client keeping track of the node health'''
+        try:
+            res = fn(*args, **kwargs)
+        except ESConnectionError:
+            self.client.mark(False)
+            raise
+        self.client.mark(True)
+        return res
 
     def connect(self):
-        self.es = Elasticsearch([{'host': self.host, 'port': self.port}])
+        self.client = get_client(self.host, self.port)
+        self.es = self.client.es
         if self.is_connected():
             msg = 'Connected to ElasticSearch on'
             logger.info('{msg} {host}:{port}'.format(msg=msg, host=self.host,
@@ -43,9 +130,9 @@ class ES():
             return
 
         msg = "Do you want to delete the index '{}'?".format(index_name)
-        if self.es.indices.exists(index_name):
+        if self._request(self.es.indices.exists, index_name):
             if utils.query_yes_no(msg, False):
-                res = self.es.indices.delete(index=index_name)
+                res = self._request(self.es.indices.delete, index=index_name)
                 logger.info("The index {} was deleted successfully".
                              format(index_name))
         return True
@@ -66,11 +153,10 @@ class ES():
             return
 
         try:
-            if not self.es.indices.exists(index_name):
+            if not self._request(self.es.indices.exists, index_name):
                 # Ignore 400 means to ignore "Index Already Exist" error.
-                res = self.es.indices.create(index=index_name,
-                                             body=mapping,
-                                             ignore=[400, 404])
+                res = self._request(self.es.indices.create, index=index_name,
+                                    body=mapping, ignore=[400, 404])
         except Exception as ex:
             logger.error("Error creating the index '{}'.Error: {}".
                          format(index_name, str(ex)))
@@ -103,7 +189,8 @@ class ES():
         logger.debug("Gevent (before es_obj.index): '{}'".format(gevent.getcurrent().name))
         
         try:
-            res = self.es.index(index=index_name, doc_type=doc_name, body=content)
+            res = self._request(self.es.index, index=index_name,
+                                doc_type=doc_name, body=content)
         except Exception as ex:
             logger.error('Error. Something went wrong storing the data')
             return
@@ -113,6 +200,99 @@ class ES():
             return res
     
     
+    def _bulk_chunks(self, index_name, doc_name, docs, ids, chunk_size,
+                     max_chunk_bytes):
+        '''Yield (positions, ndjson body) limited by count and bytes'''
+        serializer = self.es.transport.serializer
+        positions, lines, size = [], [], 0
+        for pos, doc in enumerate(docs):
+            action = {'_index': index_name, '_type': doc_name}
+            if ids and ids[pos] is not None:
+                action['_id'] = ids[pos]
+            item = (serializer.dumps({'index': action}) + '\n' +
+                    serializer.dumps(doc) + '\n')
+            item_size = len(item.encode('utf-8'))
+
+            if positions and (len(positions) >= chunk_size or
+                              size + item_size > max_chunk_bytes):
+                yield positions, ''.join(lines)
+                positions, lines, size = [], [], 0
+
+            positions.append(pos)
+            lines.append(item)
+            size += item_size
+
+        if positions:
+            yield positions, ''.join(lines)
+
+    def bulk_store(self, index_name, doc_name, docs, ids=None,
+                   chunk_size=500, max_chunk_bytes=10 * 1024 * 1024,
+                   max_retries=3, backoff=1.0):
+        '''
+        Store docs with the _bulk API. Requests are split by count and
+        bytes; only the items rejected with a retryable status are sent
+        again. Returns one {'ok', 'status', 'id', 'error'} per doc, in order.
+        '''
+
+        if not self.is_connected():
+            logger.error('Error. Not connected to Elasticsearch')
+            return
+
+        if type(index_name) is not str:
+            logger.error('Error. Index name must be a str')
+            return
+
+        if type(doc_name) is not str:
+            logger.error('Error. Missing document name to store in Elasticsearch')
+            return
+
+        results = [{'ok': False, 'status': None, 'id': None,
+                    'error': 'not sent'} for _ in docs]
+        pending = list(range(len(docs)))
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                gevent.sleep(backoff * 2 ** (attempt - 1))
+
+            retry = []
+            for chunk, body in self._bulk_chunks(
+                    index_name, doc_name, [docs[p] for p in pending],
+                    [ids[p] for p in pending] if ids else None,
+                    chunk_size, max_chunk_bytes):
+                chunk = [pending[p] for p in chunk]
+                t1 = time()
+                try:
+                    res = self._request(self.es.bulk, body=body)
+                except TransportError as ex:
+                    logger.error('Error. Bulk request failed: {}'.format(str(ex)))
+                    for pos in chunk:
+                        results[pos]['error'] = str(ex)
+                    retry.extend(chunk)
+                    continue
+                logger.debug("Bulk of {} docs: {} secs".
+                             format(len(chunk), time() - t1))
+
+                for pos, item in zip(chunk, res.get('items', [])):
+                    item = item.get('index', {})
+                    status = item.get('status')
+                    ok = status is not None and 200 <= status < 300
+                    results[pos] = {'ok': ok, 'status': status,
+                                    'id': item.get('_id'),
+                                    'error': None if ok else str(item.get('error'))}
+                    if status in BULK_RETRY_STATUS:
+                        retry.append(pos)
+
+            pending = retry
+            if not pending:
+                break
+
+        failed = sum(1 for r in results if not r['ok'])
+        if failed:
+            logger.error("Bulk store into '{}': {} of {} docs failed".
+                         format(index_name, failed, len(docs)))
+        return results
+
+
     def search(self, index_name, content):
         
         if not self.is_connected():
@@ -127,5 +307,37 @@ class ES():
             loggin.error('Error. Content must be a dictionary')
             return
         
-        return self.es.search(index=index_name, body=content)
-    
+        return self._request(self.es.search, index=index_name, body=content)
+
+
+    def put_alias(self, index_name, alias):
+
+        if not self.is_connected():
+            logger.error('Error. Not connected to Elasticsearch')
+            return
+
+        try:
+            self._request(self.es.indices.put_alias, index=index_name,
+                          name=alias)
+        except Exception as ex:
+            logger.error("Error creating the alias '{}' of '{}'. Error: {}".
+                         format(alias, index_name, str(ex)))
+            return
+        else:
+            logger.info("Alias '{}' points to '{}'".format(alias, index_name))
+            return True
+
+
+    def scan(self, index_name, query=None, size=1000):
+        '''Iterate over every hit of the query with the scroll API'''
+
+        if not self.is_connected():
+            logger.error('Error. Not connected to Elasticsearch')
+            return iter(())
+
+        if type(index_name) is not str:
+            logger.error('Error. Index name must be a str')
+            return iter(())
+
+        return scan(self.es, query=query, index=index_name, size=size,
+                    scroll='5m')
@@ -0,0 +1,195 @@
+from gevent import monkey
+monkey.patch_all()
+import gevent
+import gevent.pool
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import metrics
+from config import config
+from control import logger
+
+
+BACKENDS = ('process', 'thread', 'gevent')
+
+
+class TaskError(Exception):
+    pass
+
+
+class TaskTimeout(TaskError):
+    pass
+
+
+class TaskCrashed(TaskError):
+    pass
+
+
+class Executor():
+    '''
+    Runs CPU bound tasks (parse_pdf) on a pool of workers.
+
+    backend:
+        'process'  one process per core, real parallelism (default)
+        'thread'   thread pool, useful for debugging
+        'gevent'   greenlet pool, the previous behaviour
+    '''
+
+    def __init__(self, backend='process', workers=None, timeout=None,
+                 start_method=None):
+
+        if backend not in BACKENDS:
+            raise ValueError("Unknown executor backend '{}'. Valid: {}".
+                             format(backend, ', '.join(BACKENDS)))
+
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.start_method = start_method
+        self._pool = None
+        self._generation = 0
+        self._causes = {}       # generation -> 'timeout' | 'crash'
+
+    def _create_pool(self):
+        if self.backend == 'process':
+            ctx = None
+            if self.start_method:
+                ctx = multiprocessing.get_context(self.start_method)
+            return ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+        if self.backend == 'thread':
+            return ThreadPoolExecutor(max_workers=self.workers)
+        return gevent.pool.Pool(self.workers)
+
+    def start(self):
+        if self._pool is None:
+            self._pool = self._create_pool()
+            logger.info("Executor started: backend '{}', {} workers".
+                        format(self.backend, self.workers))
+        return self
+
+    def shutdown(self):
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        if self.backend == 'gevent':
+            pool.kill()
+        else:
+            pool.shutdown(wait=True)
+
+    def _recycle(self, generation, cause):
+        # Several waiters see the same broken pool; only the first one
+        # replaces it, and records why for the others.
+        if generation != self._generation:
+            return
+
+        pool = self._pool
+        self._causes[generation] = cause
+        for old in [g for g in self._causes if g < generation - 16]:
+            del self._causes[old]
+        self._generation += 1
+        self._pool = self._create_pool()
+        logger.error("Executor pool recycled after a {} (generation {})".
+                     format(cause, self._generation))
+
+        if self.backend == 'process':
+            # A hung worker never returns, so it has to be killed. Tasks
+            # still running on the old pool get BrokenProcessPool and are
+            # resubmitted by their waiters.
+            self._terminate(pool)
+        pool.shutdown(wait=False)
+
+    def _terminate(self, pool):
+        for proc in list((getattr(pool, '_processes', None) or {}).values()):
+            proc.terminate()
+
+    def _result(self, pool, fn, args, kwargs):
+        if self.backend == 'process':
+            # what the worker recorded comes back with the result
+            future = pool.submit(metrics.collecting, fn, *args, **kwargs)
+            try:
+                result, delta = future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise
+            metrics.REGISTRY.merge(delta)
+            return result
+        future = pool.submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def _run_isolated(self, name, fn, args, kwargs):
+        '''
+        Run a task that was on a pool when one of its workers died, alone
+        on a pool of its own: if it crashes again it is the culprit, and
+        the other tasks are not taken down with it.
+        '''
+        pool = self._create_pool()
+        try:
+            return self._result(pool, fn, args, kwargs)
+        except FutureTimeoutError:
+            raise TaskTimeout("'{}' timed out after {} secs".
+                              format(name, self.timeout))
+        except BrokenProcessPool:
+            raise TaskCrashed("Worker running '{}' died".format(name))
+        finally:
+            self._terminate(pool)
+            pool.shutdown(wait=False)
+
+    def run(self, fn, *args, **kwargs):
+        '''
+        Run fn(*args, **kwargs) on the pool and wait for the result.
+
+        Raises TaskTimeout if the task takes longer than self.timeout and
+        TaskCrashed if the worker running it died. A hung task takes the
+        whole process pool down with it: the other tasks running on it are
+        resubmitted without counting it against them. When a worker
+        crashes, the tasks that were running are run again one by one on
+        a pool of their own, so only the one crashing fails.
+        '''
+
+        self.start()
+        name = getattr(fn, '__name__', str(fn))
+
+        if self.backend == 'gevent':
+            g = self._pool.spawn(fn, *args, **kwargs)
+            try:
+                return g.get(timeout=self.timeout)
+            except gevent.Timeout:
+                g.kill(block=False)
+                raise TaskTimeout("'{}' timed out after {} secs".
+                                  format(name, self.timeout))
+
+        while True:
+            generation = self._generation
+            try:
+                return self._result(self._pool, fn, args, kwargs)
+            except FutureTimeoutError:
+                if self.backend == 'process':
+                    self._recycle(generation, 'timeout')
+                raise TaskTimeout("'{}' timed out after {} secs".
+                                  format(name, self.timeout))
+            except BrokenProcessPool:
+                self._recycle(generation, 'crash')
+                if self._causes.get(generation) == 'timeout':
+                    continue    # killed for another task, just run it again
+                return self._run_isolated(name, fn, args, kwargs)
+
+
+_executor = None
+
+
+def get_executor():
+    '''Process wide executor built from config['executor']'''
+    global _executor
+    if _executor is None:
+        conf = config.get('executor', {})
+        _executor = Executor(backend=conf.get('backend', 'process'),
+                             workers=conf.get('workers'),
+                             timeout=conf.get('task_timeout'),
+                             start_method=conf.get('start_method'))
+    return _executor
@@ -0,0 +1,261 @@
+from gevent import monkey
+monkey.patch_all()
+import os
+import re
+import codecs
+import tempfile
+from subprocess import Popen, PIPE
+from config import config
+import utils
+import metrics
+from control import logger
+
+fitz = None
+
+
+class ExtractError(Exception):
+    pass
+
+
+def pymupdf():
+    '''PyMuPDF, imported on first use. None when not installed'''
+    global fitz
+    if fitz is None:
+        try:
+            import fitz
+        except ImportError:
+            return None
+    return fitz
+
+
+def regex_srch(text, search):
+    match = ''
+    try:
+        match = re.search(r'(?<='+search+').*', text).group().strip()
+    except:
+        return None
+    else:
+        return utils.remove_non_printable_chars(match)
+
+
+def get_pdfinfo(pdf_path, userpw=None):
+    try:
+        if userpw is not None:
+            proc = Popen(["pdfinfo", pdf_path, '-upw', userpw],
+                         stdout=PIPE, stderr=PIPE)
+        else:
+            proc = Popen(["pdfinfo", pdf_path], stdout=PIPE, stderr=PIPE)
+
+        out, err = proc.communicate()
+    except:
+        from pdf2image.exceptions import PDFInfoNotInstalledError
+        raise PDFInfoNotInstalledError(('Unable to get page count. ' +
+                                        'Is poppler installed and in PATH?'))
+
+    try:
+
+        data = out.decode("utf8", "ignore")
+        pdfinfo = {
+            'title': regex_srch(data, 'Title:'),
+            'creator': regex_srch(data, 'Creator:'),
+            'producer': regex_srch(data, 'Producer:'),
+            'tragged': regex_srch(data, 'Tagged:'),
+            'user_properties': regex_srch(data, 'UserProperties:'),
+            'suspects': regex_srch(data, 'Suspects:'),
+            'from': regex_srch(data, 'Form:'),
+            'javascript': regex_srch(data, 'JavaScript:'),
+            'pages': utils.input2num(regex_srch(data, 'Pages:')),
+            'encripted': regex_srch(data, 'Encrypted:'),
+            'page_size': regex_srch(data, 'Page size:'),
+            'page_rot': regex_srch(data, 'Page rot:'),
+            'file_size': regex_srch(data, 'File size:'),
+            'optimized': regex_srch(data, 'Optimized:'),
+            'pdf_version': regex_srch(data, 'PDF version:'),
+            'creation_date': regex_srch(data, 'CreationDate:'),
+            'author': regex_srch(data, 'Author:')
+        }
+        return pdfinfo
+    except:
+        from pdf2image.exceptions import PDFPageCountError
+        raise PDFPageCountError('Unable to get pdf info. %s' % err.decode("utf8", "ignore"))
+
+
+class Extractor():
+    '''
+    Reads a PDF. open() returns (pdfinfo, pieces): pdfinfo has the keys of
+    get_pdfinfo and pieces is an iterator of str whose concatenation is the
+    text of the document, so big documents can be processed as a stream.
+    '''
+
+    name = None
+
+    def open(self, pdf_path, encoding='utf-8', stream_pages=None):
+        raise NotImplementedError
+
+    def extract(self, pdf_path, encoding='utf-8'):
+        pdfinfo, pieces = self.open(pdf_path, encoding)
+        return {'text': ''.join(pieces), 'pdfinfo': pdfinfo}
+
+
+class TextractExtractor(Extractor):
+    '''
+    pdfinfo and pdftotext (through textract) subprocesses. Documents with
+    more than stream_pages pages are read from a pdftotext pipe instead.
+    '''
+
+    name = 'textract'
+
+    def open(self, pdf_path, encoding='utf-8', stream_pages=None):
+        with metrics.STEP_SECONDS.time('pdfinfo'):
+            pdfinfo = get_pdfinfo(pdf_path)
+        if stream_pages and pdfinfo.get('pages', -1) > stream_pages:
+            return pdfinfo, metrics.TimedIter(
+                self._pdftotext(pdf_path, encoding),
+                metrics.STEP_SECONDS.labels('extract'))
+        import textract
+        with metrics.STEP_SECONDS.time('extract'):
+            text = textract.process(pdf_path, encoding=encoding)
+        return pdfinfo, iter([text.decode(encoding)])
+
+    def _pdftotext(self, pdf_path, encoding, blocksize=1048576, first_page=1):
+        # the same command textract runs for a pdf. stderr goes to a file:
+        # a damaged pdf can write more errors than a pipe holds while we
+        # are only reading stdout
+        err = tempfile.TemporaryFile()
+        proc = Popen(['pdftotext', '-f', str(first_page), pdf_path, '-'],
+                     stdout=PIPE, stderr=err)
+        decoder = codecs.getincrementaldecoder(encoding)('ignore')
+        try:
+            for block in iter(lambda: proc.stdout.read(blocksize), b''):
+                yield decoder.decode(block)
+            if proc.wait() != 0:
+                err.seek(0)
+                raise ExtractError('pdftotext exited with {}: {}'.format(
+                    proc.returncode,
+                    err.read().decode('utf-8', 'ignore').strip()[-1000:]))
+            yield decoder.decode(b'', final=True)
+        finally:
+            proc.stdout.close()
+            err.close()
+            if proc.poll() is None:     # the reader stopped early
+                proc.kill()
+                proc.wait()
+
+
+def _clean(value):
+    return utils.remove_non_printable_chars(str(value)) if value else None
+
+
+class MuPDFExtractor(Extractor):
+    '''
+    In process extraction with PyMuPDF: the file is opened once and text,
+    page count and document info come from the same pass. Text is yielded
+    page by page, pages separated by a form feed as pdftotext does. When
+    MuPDF fails on a page, the rest of the document is read with pdftotext.
+    '''
+
+    name = 'mupdf'
+
+    def open(self, pdf_path, encoding='utf-8', stream_pages=None):
+        with metrics.STEP_SECONDS.time('pdfinfo'):
+            doc = pymupdf().open(pdf_path)
+            try:
+                pdfinfo = self.pdfinfo(doc, pdf_path)
+            except:
+                doc.close()
+                raise
+        return pdfinfo, metrics.TimedIter(self._pages(doc, pdf_path, encoding),
+                                          metrics.STEP_SECONDS.labels('extract'))
+
+    def _pages(self, doc, pdf_path, encoding):
+        n = 0
+        try:
+            # n names the failing page, whether it fails to load or to give
+            # its text
+            for n in range(doc.page_count):
+                text = doc.load_page(n).get_text('text')
+                yield '\f' + text if n else text
+            return
+        except Exception as ex:
+            logger.error("mupdf could not read page {} of '{}' ({}), using "
+                         "pdftotext".format(n + 1, pdf_path, str(ex)))
+        finally:
+            doc.close()
+
+        if n:
+            yield '\f'
+        yield from TextractExtractor()._pdftotext(pdf_path, encoding,
+                                                  first_page=n + 1)
+
+    def pdfinfo(self, doc, pdf_path):
+        meta = doc.metadata or {}
+        version = meta.get('format') or ''
+        page_size = page_rot = None
+        if doc.page_count:
+            first = doc[0]
+            page_size = '{:g} x {:g} pts'.format(first.rect.width,
+                                                 first.rect.height)
+            page_rot = str(first.rotation)
+
+        return {
+            'title': _clean(meta.get('title')),
+            'creator': _clean(meta.get('creator')),
+            'producer': _clean(meta.get('producer')),
+            'tragged': None,
+            'user_properties': None,
+            'suspects': None,
+            'from': 'AcroForm' if doc.is_form_pdf else 'none',
+            'javascript': None,
+            'pages': float(doc.page_count),
+            'encripted': 'yes' if meta.get('encryption') else 'no',
+            'page_size': page_size,
+            'page_rot': page_rot,
+            'file_size': '{} bytes'.format(os.path.getsize(pdf_path)),
+            'optimized': None,
+            'pdf_version': _clean(version.replace('PDF', '').strip()),
+            'creation_date': _clean(meta.get('creationDate')),
+            'author': _clean(meta.get('author'))
+        }
+
+
+EXTRACTORS = {
+    'textract': TextractExtractor,
+    'mupdf': MuPDFExtractor
+}
+
+
+def get_extractor(name=None):
+    '''
+    name: 'mupdf', 'textract' or 'auto' (mupdf when PyMuPDF is installed).
+    Defaults to config['parser']['extractor'].
+    '''
+    if name is None:
+        name = config.get('parser', {}).get('extractor', 'auto')
+    if name == 'auto':
+        name = 'mupdf' if pymupdf() is not None else 'textract'
+    if name == 'mupdf' and pymupdf() is None:
+        logger.error('PyMuPDF is not installed, using textract')
+        name = 'textract'
+    if name not in EXTRACTORS:
+        raise ValueError("Unknown extractor '{}'. Valid: {}".
+                         format(name, ', '.join(EXTRACTORS)))
+    return EXTRACTORS[name]()
+
+
+def open_pdf(pdf_path, encoding='utf-8', stream_pages=None, name=None):
+    '''Open with the configured backend, falling back to textract'''
+    extractor = get_extractor(name)
+    try:
+        return extractor.open(pdf_path, encoding, stream_pages)
+    except Exception as ex:
+        if extractor.name == 'textract':
+            raise
+        logger.error("{} could not read '{}' ({}), using textract".
+                     format(extractor.name, pdf_path, str(ex)))
+        return TextractExtractor().open(pdf_path, encoding, stream_pages)
+
+
+def extract(pdf_path, encoding='utf-8', name=None):
+    '''Extract with the configured backend, falling back to textract'''
+    pdfinfo, pieces = open_pdf(pdf_path, encoding, name=name)
+    return {'text': ''.join(pieces), 'pdfinfo': pdfinfo}
@@ -3,51 +3,247 @@ from gevent import monkey
 monkey.patch_all()
 import gevent
 import os
-import re
 import sys
 from datetime import datetime
-from apscheduler.schedulers.gevent import GeventScheduler
+from functools import partial
+from time import time
 from esdb import ES
 import utils
 import parser
+from executor import get_executor, TaskError
+from pipeline import Stage, Pipeline
+from dedupe import get_hash_index
+from scanner import get_file_state
+from watcher import Watcher, inotify_available
+from thumbnails import thumbnails
+import metrics
+from cache import DiskCache, encode_json, decode_json
+from sidestore import add_base64
 from mappings import mappings
 from config import config
-from control import logger, decfun, monitor_greenlet_status
-
-MONITOR_STATUS = False
-
-def query_builder(field, to_search):
-    query = '''
-        {{
-          "query": {{
-            "nested": {{
-              "path": "meta",
-              "query": {{
-                "term": {{
-                  "{field}": {{
-                    "value": "{to_search}"
-                  }}
-                }}
-              }}
-            }}
-          }},
-          "size": 0
-        }}
-        '''
-    query = query.replace('\n', ' ').replace('\r', '')
-    query = re.sub(' +',' ',query)
-
-    query = query.format(field=field, to_search=to_search)
-
-    return query
-
-
-def on_exception(greenlet):
-    logger.error("Greenlet '{}' died unexpectedly. Args: '{}'".
-                 format(greenlet, greenlet.args))
+from control import logger, decfun
 
-@decfun
-def main(es_addr, es_port, dir_root, dir_processed, dir_error):
+
+def file_path(file):
+    return os.path.join(file.get('root'), file.get('folder', ''),
+                        file.get('fname') + file.get('fext'))
+
+
+def make_job(file):
+    return {'file': file, 'path': file_path(file), 'status': 'new', 'data': None}
+
+
+def remove_empty_folder(root, folder):
+    if not folder:
+        return
+    directory = os.path.join(root, folder)
+    try:
+        if not any(os.path.isfile(os.path.join(directory, name))
+                   for name in os.listdir(directory)):
+            os.rmdir(directory)
+    except OSError:
+        pass
+
+
+def prehash_task(hash_index, job):
+    '''Skip files whose raw bytes were already parsed and stored'''
+
+    try:
+        job['size'] = os.path.getsize(job['path'])
+        metrics.BYTES.inc('raw', amount=job['size'])
+        # hashed on a real thread so big files do not block the hub
+        job['raw_hash'] = gevent.get_hub().threadpool.apply(
+            utils.hashfile, (job['path'],))
+    except OSError as ex:
+        logger.error("Error reading '{}': {}".format(job['path'], str(ex)))
+        return job
+
+    if hash_index.known_raw(job['raw_hash'], job['size']):
+        logger.info("File '{}' already in the database. Skipped".
+                    format(job['path']))
+        job['status'] = 'duplicated'
+    return job
+
+
+def record_raw(hash_index, jobs):
+    hash_index.add_raw((job['raw_hash'], job['size'],
+                        job['data']['meta']['content_sha512_hex'])
+                       for job in jobs if job.get('raw_hash'))
+
+
+def parse_task(executor, parse_cache, job):
+    '''Run parser.parse_pdf on the executor. Timeouts and crashed workers
+    are reported as an error result so the file goes to dir_error.
+    Results are cached by raw file hash, so a file that failed to be
+    indexed is not parsed again.'''
+
+    if job['status'] != 'new':
+        return job
+
+    file = job['file']
+    key = None
+    if parse_cache is not None and job.get('raw_hash'):
+        key = parser.cache_key(job['raw_hash'])
+        data = parse_cache.get(key)
+        if data is not None:
+            # big documents, gzip and json on a real thread
+            data = gevent.get_hub().threadpool.apply(decode_json, (data,))
+            if data is None:
+                parse_cache.delete(key)
+        if data:
+            data['meta'].update({'dir_root': file.get('root'),
+                                 'folder_file': file.get('folder'),
+                                 'filename': file.get('fname'),
+                                 'extension': file.get('fext')})
+            data['created'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            job['status'] = 'ok'
+            job['data'] = data
+            return job
+
+    kwargs = {'root': file.get('root'),
+              'folder': file.get('folder'),
+              'file_name': file.get('fname'),
+              'file_extension': file.get('fext')}
+    try:
+        result = executor.run(parser.parse_pdf, **kwargs)
+    except TaskError as ex:
+        logger.error("Error parsing '{}': {}".format(job['path'], str(ex)))
+        result = None
+
+    if not result or result.get('status') != 'ok':
+        job['status'] = 'error'
+    else:
+        job['status'] = 'ok'
+        job['data'] = result.get('data')
+        if key:
+            parse_cache.put(key, gevent.get_hub().threadpool.apply(
+                encode_json, (job['data'],)))
+    return job
+
+
+def dedupe_task(es, hash_index, jobs):
+    '''Drop the documents already stored, checking the whole batch at once'''
+
+    to_check = [job for job in jobs if job['status'] == 'ok']
+    if not to_check:
+        return jobs
+
+    hashes = [job['data']['meta']['content_sha512_hex'] for job in to_check]
+    stored = hash_index.lookup(es, hashes)
+
+    seen = set()
+    duplicated = []
+    for job, hex_dig in zip(to_check, hashes):
+        if hex_dig in stored or hex_dig in seen:
+            logger.info("File '{}' already in the database. Skipped".
+                        format(job['path']))
+            job['status'] = 'duplicated'
+            duplicated.append(job)
+        seen.add(hex_dig)
+
+    # copies of a document already stored skip the parse next time
+    record_raw(hash_index, (job for job in duplicated
+                            if job['data']['meta']['content_sha512_hex'] in stored))
+    return jobs
+
+
+def thumbnails_task(dir_processed, job):
+    if job['status'] != 'ok':
+        return job
+
+    data = job['data']
+    folder_doc = job['file'].get('folder', '')
+    filename = job['file'].get('fname')
+
+    tm = datetime.now().strftime("%Y%m%d_%H%M%S")
+    folder_img = os.path.join('images', folder_doc, filename[:filename.find('.')] + tm)
+
+    data['meta']['folder_file'] = os.path.join('files', folder_doc)
+
+    # a copy of a document already rendered reuses its folder
+    folder_img = thumbnails(job['path'], data['meta']['content_sha512_hex'],
+                            data['meta'].get('pages', -1), dir_processed,
+                            folder_img,
+                            os.path.join('files', folder_doc,
+                                         filename + job['file'].get('fext')))
+    if folder_img:
+        data['meta']['dir_root'] = dir_processed
+        data['meta']['folder_img'] = folder_img
+    else:
+        data['meta']['folder_img'] = ''
+    return job
+
+
+def index_task(es, hash_index, jobs):
+    '''Store a batch of documents. Jobs whose document did not land are
+    marked 'failed' and their file stays in dir_root for the next run.'''
+
+    conf = config.get('elasticsearch', {})
+    to_store = [job for job in jobs if job['status'] == 'ok']
+    if not to_store:
+        return jobs
+
+    for job in to_store:
+        add_base64(job['data'])
+
+    # the content hash is the document id, storing a copy twice is a no-op
+    ids = [job['data']['meta']['content_sha512_hex'] for job in to_store]
+    results = es.bulk_store('files', '_doc', [job['data'] for job in to_store],
+                            ids=ids,
+                            chunk_size=conf.get('bulk_size', 500),
+                            max_chunk_bytes=conf.get('bulk_bytes', 10485760),
+                            max_retries=conf.get('bulk_retries', 3))
+    if results is None:
+        results = [{'ok': False, 'error': 'not connected'}] * len(to_store)
+
+    for job, res in zip(to_store, results):
+        if not res['ok']:
+            logger.error("Error storing '{}': {}".
+                         format(job['path'], res.get('error')))
+            job['status'] = 'failed'
+
+    stored = [job for job in to_store if job['status'] == 'ok']
+    hash_index.add(job['data']['meta']['content_sha512_hex'] for job in stored)
+    record_raw(hash_index, stored)
+    return jobs
+
+
+def move_task(file_state, dir_processed, dir_error, job):
+    '''Files that stay in dir_root are not scanned again unless they
+    change, except the failed ones, which are retried on the next run'''
+
+    file = job['file']
+    folder_doc = file.get('folder', '')
+    metrics.DOCUMENTS.inc(job['status'])
+
+    if job['status'] == 'error':
+        utils.move_to(job['path'], os.path.join(dir_error, folder_doc))
+    elif job['status'] == 'ok':
+        utils.move_to(job['path'], os.path.join(dir_processed, 'files', folder_doc))
+    else:
+        if job['status'] == 'duplicated':
+            file_state.done(job['path'])
+        return job
+
+    file_state.forget(job['path'])
+
+    remove_empty_folder(file.get('root'), folder_doc)
+    return job
+
+
+_parse_cache = None
+
+
+def get_parse_cache():
+    global _parse_cache
+    conf = config.get('cache', {})
+    if _parse_cache is None and conf.get('enabled', True):
+        _parse_cache = DiskCache(conf['dir'], conf.get('max_bytes', 2 << 30),
+                                 suffix='.json.gz')
+    return _parse_cache
+
+
+def prepare_dirs(dir_root, dir_processed, dir_error):
 
     if not os.path.isabs(dir_root):
         dir_root = os.path.abspath(dir_root)
@@ -58,106 +254,158 @@ def main(es_addr, es_port, dir_root, dir_processed, dir_error):
 
     utils.create_directory(dir_processed)
     utils.create_directory(dir_error)
+    return dir_root, dir_processed, dir_error
+
+
+def build_stages(es, executor, hash_index, file_state, dir_processed,
+                 dir_error):
+    conf = config.get('pipeline', {})
+    workers = conf.get('workers', {})
+
+    # discover -> prehash -> parse -> dedupe -> thumbnails -> index -> move
+    return [
+        Stage('discover', make_job),
+        Stage('prehash', partial(prehash_task, hash_index),
+              workers=workers.get('prehash', 2)),
+        Stage('parse', partial(parse_task, executor, get_parse_cache()),
+              workers=executor.workers),
+        Stage('dedupe', partial(dedupe_task, es, hash_index),
+              workers=workers.get('dedupe', 1),
+              batch_size=conf.get('dedupe_batch', 50),
+              batch_secs=conf.get('dedupe_flush_secs', 1)),
+        Stage('thumbnails', partial(thumbnails_task, dir_processed),
+              workers=workers.get('thumbnails', 2)),
+        Stage('index', partial(index_task, es, hash_index),
+              workers=workers.get('index', 2),
+              batch_size=conf.get('index_batch', 100),
+              batch_secs=conf.get('index_flush_secs', 2)),
+        Stage('move', partial(move_task, file_state, dir_processed, dir_error),
+              workers=workers.get('move', 1))
+    ]
+
 
-    status_time = 10
+@decfun
+def main(es_addr, es_port, dir_root, dir_processed, dir_error):
 
-    utils.replace_recursively(dir_root)
-    files = utils.files_in_dir_recursively(dir_root, '.pdf')
+    dir_root, dir_processed, dir_error = prepare_dirs(dir_root, dir_processed,
+                                                      dir_error)
+
+    # only the files added or changed since the last run
+    file_state = get_file_state()
+    with metrics.STAGE_SECONDS.time('scan'):
+        files = list(file_state.scan(dir_root, '.pdf', exclude_dir=dir_error,
+                                     rename=config['scanner'].get('rename', True)))
+    metrics.ITEMS.inc('scan', amount=len(files))
 
     if len(files) == 0:
-        logger.info("Directory '{}' is empty".format(dir_root))
+        logger.info("No new files in '{}'".format(dir_root))
         return
 
-    chunks_size = 10
-    chunk_of_files = list(utils.chunks(files, chunks_size))
-    
-    round = 1
-    for cfs in chunk_of_files:
-        logger.info('Round: {}/{}, Files (round/total): {}/{}'.
-                    format(round, len(chunk_of_files), len(cfs), len(files)))
-        g1 = []
-        for file in cfs:
-            g1.append(gevent.spawn(parser.parse_pdf,
-                                   root=file.get('root'),
-                                   folder=file.get('folder'),
-                                   file_name=file.get('fname'),
-                                   file_extension=file.get('fext')))
-
-        foo = [g.link_exception(on_exception) for g in g1]
-
-        if MONITOR_STATUS: monitor_greenlet_status(g1, status_time)
-
-        gevent.joinall(g1)
-        
-        es = ES(es_addr, es_port)
-        es.connect()
-
-        g2 = []
-        for g in g1:
-            result = g.value
-            
-            if not result: continue
-            
-            n = 0
-            data = result.get('data')
-           
-            dir_from = data.get('meta', {}).get('dir_root')
-            folder_doc = data.get('meta', {}).get('folder_file', '')
-            filename = data.get('meta', {}).get('filename')
-            file_extension = data.get('meta', {}).get('extension')
-            
-            full_path2file = os.path.join(dir_from, folder_doc, filename + file_extension)
-            
-            if result.get('status') == 'error':
-                dir_to = os.path.join(dir_error, folder_doc)
-                utils.move_to(filename, dir_to)
-                directory = os.path.join(dir_from, folder_doc)
-                if len([name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name))]) == 0:
-                    os.rmdir(os.path.join(dir_from, folder_doc))
+    logger.info('Files to process: {}'.format(len(files)))
 
-            else:
-                to_search = data.get('meta', {}).get('content_sha512_hex')
-                query = query_builder(
-                    field="meta.content_sha512_hex",
-                    to_search=to_search)
-
-                if es.search('files', query)['hits']['total'] == 0:
-                    tm = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    
-                    folder_img = os.path.join('images', folder_doc, filename[:filename.find('.')] + tm)
-                    dir_to_img = os.path.join(dir_processed, folder_img)
-                    
-                    folder_file = os.path.join('files', folder_doc)
-                    data['meta']['folder_file'] = folder_file
-                    
-                    if parser.parse_pdf2img(full_path2file, dir_to_img):
-                        data['meta']['dir_root'] = dir_processed
-                        data['meta']['folder_img'] = folder_img
-                    else:
-                        data['meta']['folder_img'] = ''
-
-                    g2.append(gevent.spawn(es.store_record, 'files', '_doc', data))
-                    foo = [g.link_exception(on_exception) for g in g2]
-                    
-                    dir_to = os.path.join(dir_processed, folder_file)
-                    utils.move_to(full_path2file, dir_to)
-                    directory = os.path.join(dir_from, folder_doc)
-                    if len([name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name))]) == 0:
-                        os.rmdir(os.path.join(dir_from, folder_doc))
-                        
-                else:
-                    logger.info("File '{}' already in the database. Skipped".
-                                format(data.get('meta', {}).get('path_file')))
-                
-                
-
-        if MONITOR_STATUS: monitor_greenlet_status(g2, status_time)
-
-        gevent.joinall(g2)
-        round +=1
+    executor = get_executor().start()
+
+    es = ES(es_addr, es_port)
+    es.connect()
+
+    stages = build_stages(es, executor, get_hash_index(), file_state,
+                          dir_processed, dir_error)
+
+    conf = config.get('pipeline', {})
+    pipeline = Pipeline(stages, maxsize=conf.get('queue_size', 50))
+    pipeline.run(files, status_secs=conf.get('status_secs', 10))
     return
 
 
+def release_task(inflight, job):
+    inflight.pop(job['path'], None)
+    return None
+
+
+@decfun
+def watch(es_addr, es_port, dir_root, dir_processed, dir_error, sweep_min):
+    '''
+    Long lived pipeline fed by an inotify watch of dir_root: files are
+    queued as soon as they are written. The tree is scanned at start and
+    every sweep_min minutes to catch what the watch missed.
+    '''
+
+    dir_root, dir_processed, dir_error = prepare_dirs(dir_root, dir_processed,
+                                                      dir_error)
+    conf_watch = config.get('watch', {})
+    rename = config['scanner'].get('rename', True)
+    file_state = get_file_state()
+
+    executor = get_executor().start()
+
+    es = ES(es_addr, es_port)
+    es.connect()
+
+    # path -> time queued, files already in the pipeline are not queued
+    # again by a sweep or a late event
+    inflight = {}
+    stages = build_stages(es, executor, get_hash_index(), file_state,
+                          dir_processed, dir_error)
+    stages.append(Stage('release', partial(release_task, inflight)))
+
+    conf = config.get('pipeline', {})
+    pipeline = Pipeline(stages, maxsize=conf.get('queue_size', 50))
+    pipeline.start(status_secs=conf.get('status_secs', 10))
+
+    settle_secs = conf_watch.get('settle_secs', 2)
+
+    def settling(path):
+        '''Still being written: the watch reports it once it settles'''
+        if watcher.is_pending(path):
+            return True
+        try:
+            return os.stat(path).st_mtime > time() - settle_secs
+        except OSError:
+            return True
+
+    def submit(files, sweep=False):
+        queued = 0
+        expired = time() - conf_watch.get('inflight_secs', 3600)
+        for file in files:
+            if file is None:
+                continue
+            path = file_path(file)
+            if inflight.get(path, 0) > expired:
+                continue
+            if sweep and settling(path):
+                continue
+            inflight[path] = time()
+            pipeline.put(file)
+            queued += 1
+        return queued
+
+    def on_change(kind, path):
+        with metrics.STAGE_SECONDS.time('scan'):
+            if kind == 'file':
+                files = [file_state.check(dir_root, path, rename)]
+            else:
+                files = list(file_state.scan(
+                    dir_root, '.pdf', exclude_dir=dir_error, rename=rename,
+                    top=path if kind == 'dir' else None))
+        metrics.ITEMS.inc('scan', amount=sum(1 for f in files if f))
+        queued = submit(files, sweep=kind == 'sweep')
+        if queued:
+            logger.info("Queued {} files ({} '{}')".format(queued, kind, path))
+
+    watcher = Watcher(dir_root, on_change, exclude=(dir_error, dir_processed),
+                      extension='.pdf',
+                      settle_secs=settle_secs).start()
+    try:
+        while True:
+            on_change('sweep', dir_root)
+            gevent.sleep(sweep_min * 60)
+    finally:
+        watcher.stop()
+        pipeline.close()
+        pipeline.join()
+        executor.shutdown()
+
+
 def es_init(es_addr, es_port):
 
     es = ES(es_addr, es_port)
@@ -172,10 +420,15 @@ def es_init(es_addr, es_port):
             logger.error("Error creating index '{}'".format(idx))
             return
 
+    if config.get('dedupe', {}).get('warm_on_start', True):
+        get_hash_index().warm(es, 'files')
+
     return
 
 
 if __name__ == '__main__':
+    # only the scheduling process needs it, not the spawned workers
+    from apscheduler.schedulers.gevent import GeventScheduler
 
     scheduler = GeventScheduler()
     config_app = config.get('app')
@@ -208,6 +461,23 @@ if __name__ == '__main__':
 
     es_init(es_addr, es_port)
 
+    config_metrics = config.get('metrics', {})
+    if config_metrics.get('enabled', True):
+        metrics.start_server(config_metrics.get('host', '127.0.0.1'),
+                             config_metrics.get('port', 9108))
+
+    if config.get('watch', {}).get('enabled'):
+        if inotify_available():
+            try:
+                watch(es_addr, es_port, dir_root, dir_processed, dir_error,
+                      interval)
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            logger.info('[  end  ] {}'.format(__name__))
+            sys.exit(0)
+        logger.error('inotify not available, scanning every {} minutes'.
+                     format(interval))
+
     scheduler.add_job(main, 'interval', minutes=interval, name='main_job',
         next_run_time=datetime.now(), replace_existing=True,
         max_instances=1,
@@ -0,0 +1,340 @@
+from gevent import monkey
+monkey.patch_all()
+import math
+from bisect import bisect_left
+from time import perf_counter
+from control import logger
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600)
+
+
+class _Timer():
+    '''Context manager observing the elapsed seconds on a histogram'''
+
+    __slots__ = ('child', 't0')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.child.observe(perf_counter() - self.t0)
+
+
+class TimedIter():
+    '''
+    Wraps an iterator, adding up the time spent producing its items.
+    The total is observed on the histogram when it is exhausted.
+    '''
+
+    def __init__(self, iterable, child):
+        self.it = iter(iterable)
+        self.child = child
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t0 = perf_counter()
+        try:
+            item = next(self.it)
+        except StopIteration:
+            self.elapsed += perf_counter() - t0
+            self.child.observe(self.elapsed)
+            raise
+        self.elapsed += perf_counter() - t0
+        return item
+
+
+class CounterValue():
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def drain(self):
+        value, self.value = self.value, 0
+        return value
+
+    def merge(self, value):
+        self.value += value
+
+
+class GaugeValue():
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class HistogramValue():
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def drain(self):
+        data = (self.counts, self.sum)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        return data
+
+    def merge(self, data):
+        counts, total = data
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.sum += total
+
+
+class Metric():
+    '''
+    A metric family: one value per combination of label values, created
+    on first use. labels() is a dict lookup, keep the child around in hot
+    loops.
+    '''
+
+    kind = None
+    value_class = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def _new(self):
+        return self.value_class()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("'{}' expects labels {}".
+                                 format(self.name, self.labelnames))
+            child = self.children[values] = self._new()
+        return child
+
+    def samples(self):
+        for values, child in self.children.items():
+            yield self.name, dict(zip(self.labelnames, values)), child.value
+
+
+class Counter(Metric):
+    kind = 'counter'
+    value_class = CounterValue
+
+    def inc(self, *values, amount=1):
+        self.labels(*values).inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    value_class = GaugeValue
+
+    def set(self, value, *values):
+        self.labels(*values).set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new(self):
+        return HistogramValue(self.bounds)
+
+    def observe(self, value, *values):
+        self.labels(*values).observe(value)
+
+    def time(self, *values):
+        return _Timer(self.labels(*values))
+
+    def samples(self):
+        for values, child in self.children.items():
+            labels = dict(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, n in zip(self.bounds + (math.inf,), child.counts):
+                cumulative += n
+                yield (self.name + '_bucket',
+                       dict(labels, le=_format_value(bound)), cumulative)
+            yield self.name + '_sum', labels, child.sum
+            yield self.name + '_count', labels, cumulative
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels.items()) + '}'
+
+
+class Registry():
+    '''
+    Metrics of this process. Updates are plain attribute increments (one
+    greenlet runs at a time), the worker processes of the executor send
+    what they recorded back with every result (see collecting()).
+    Collectors are called before every exposition, to refresh gauges
+    computed from other state.
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric '{}' already registered".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, fn):
+        self.collectors.append(fn)
+
+    def remove_collector(self, fn):
+        if fn in self.collectors:
+            self.collectors.remove(fn)
+
+    def drain(self):
+        '''Counters and histograms recorded since the last drain'''
+        delta = []
+        for metric in self.metrics.values():
+            if metric.kind == 'gauge':
+                continue
+            for values, child in metric.children.items():
+                delta.append((metric.name, values, child.drain()))
+        return delta
+
+    def merge(self, delta):
+        for name, values, data in delta:
+            metric = self.metrics.get(name)
+            if metric is not None:
+                metric.labels(*values).merge(data)
+
+    def exposition(self):
+        '''Prometheus text format (0.0.4)'''
+        for fn in self.collectors:
+            try:
+                fn()
+            except Exception as ex:
+                logger.error('Metrics collector failed: {}'.format(str(ex)))
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                              _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+# what the ingest records
+STAGE_SECONDS = histogram(
+    'docparser_stage_seconds',
+    'Seconds per call of a pipeline stage (per batch for batched stages)',
+    ('stage',))
+STEP_SECONDS = histogram(
+    'docparser_parse_step_seconds',
+    'Seconds per document of a step of parse_pdf (summary includes sentiment)',
+    ('step',))
+ITEMS = counter('docparser_stage_items_total',
+                'Items processed by a pipeline stage', ('stage',))
+ERRORS = counter('docparser_stage_errors_total',
+                 'Items lost to an exception in a pipeline stage', ('stage',))
+DOCUMENTS = counter('docparser_documents_total',
+                    'Files through the pipeline by final status', ('status',))
+BYTES = counter('docparser_bytes_total',
+                'Bytes processed: raw pdf files read, clean text produced',
+                ('kind',))
+QUEUE = gauge('docparser_stage_queue', 'Items waiting in front of a stage',
+              ('stage',))
+RATE = gauge('docparser_stage_rate',
+             'Items per second through a stage since the pipeline started',
+             ('stage',))
+BUSY = gauge('docparser_stage_busy_ratio',
+             'Share of the time the workers of a stage were busy', ('stage',))
+
+
+def collecting(fn, *args, **kwargs):
+    '''Run fn in a worker process: returns (result, metrics recorded by
+    the call) so the parent can merge them'''
+    REGISTRY.drain()
+    result = fn(*args, **kwargs)
+    return result, REGISTRY.drain()
+
+
+def make_app(registry=REGISTRY):
+
+    def app(environ, start_response):
+        if environ.get('PATH_INFO') not in ('/metrics', '/'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'']
+        body = registry.exposition().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+    return app
+
+
+def start_server(host='127.0.0.1', port=9108):
+    '''Serve /metrics from a greenlet of this process'''
+    from gevent.pywsgi import WSGIServer
+    server = WSGIServer((host, port), make_app(), log=None)
+    server.start()
+    logger.info('Metrics on http://{}:{}/metrics'.format(host, port))
+    return server
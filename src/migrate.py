@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+'''
+Reindex the documents of the 'files' index into a new index, applying
+config['base64']['mode'] to content_base64 (dropped, kept or moved to the
+side store) and using the content hash as document id. Once copied, the
+old index can be deleted and its name becomes an alias of the new one.
+
+    python migrate.py [source] [dest]
+'''
+from gevent import monkey
+monkey.patch_all()
+import sys
+from esdb import ES
+from mappings import mappings
+from config import config
+from control import logger
+from sidestore import add_base64
+
+
+def _flush(es, dest, docs, ids):
+    results = es.bulk_store(dest, '_doc', docs, ids=ids) or []
+    return sum(1 for res in results if res['ok'])
+
+
+def migrate_files_index(es, source='files', dest='files_v2', batch=500):
+    '''Copy source into dest. Returns (copied, failed)'''
+
+    if not es.create_index(dest, mappings['files']):
+        logger.error("Error creating index '{}'".format(dest))
+        return 0, 0
+
+    copied = total = 0
+    docs, ids = [], []
+    for hit in es.scan(source, {'query': {'match_all': {}}}):
+        doc = hit['_source']
+        doc.pop('content_base64', None)
+        add_base64(doc)
+        docs.append(doc)
+        ids.append(doc.get('meta', {}).get('content_sha512_hex') or hit['_id'])
+        total += 1
+
+        if len(docs) >= batch:
+            copied += _flush(es, dest, docs, ids)
+            docs, ids = [], []
+            logger.info("Migrated {} documents from '{}' to '{}'".
+                        format(copied, source, dest))
+
+    if docs:
+        copied += _flush(es, dest, docs, ids)
+
+    return copied, total - copied
+
+
+if __name__ == '__main__':
+
+    source = sys.argv[1] if len(sys.argv) > 1 else 'files'
+    dest = sys.argv[2] if len(sys.argv) > 2 else source + '_v2'
+
+    config_es = config.get('elasticsearch')
+    es = ES(config_es.get('host', '127.0.0.1'), config_es.get('port', 9200))
+    es.connect()
+
+    copied, failed = migrate_files_index(es, source, dest)
+    logger.info("Migration '{}' -> '{}': {} copied, {} failed".
+                format(source, dest, copied, failed))
+    if failed:
+        logger.error("Not replacing '{}', some documents failed".format(source))
+        sys.exit(1)
+
+    es.secure_delete_index(source)
+    if es.es.indices.exists(source):
+        logger.info("'{}' kept. Point the app to '{}' to use it".
+                    format(source, dest))
+    elif not es.put_alias(dest, source):
+        sys.exit(1)
+
+    sys.exit(0)
@@ -2,76 +2,50 @@ from gevent import monkey
 monkey.patch_all()
 import gevent
 import os
-import re
-import base64
 import hashlib
-import subprocess
 import uuid
-import shutil
-from subprocess import Popen, PIPE
-import textract
-from pdf2image import convert_from_path, convert_from_bytes
-from pdf2image.exceptions import (
-    PDFInfoNotInstalledError,
-    PDFPageCountError,
-    PDFSyntaxError
-)
 from datetime import datetime
-from time import time
-import tempfile
+from time import time, perf_counter
 import utils
+import cleaner
+import pdfcheck
+import extractors
+import thumbnails
+import metrics
+from config import config
 from control import logger, decfun
 from text_summary import text_summary
 
 
-def regex_srch(text, search):
-    match = ''
-    try:
-        match = re.search(r'(?<='+search+').*', text).group().strip()
-    except:
-        return None
-    else:
-        return utils.remove_non_printable_chars(match)
+# bump when a change alters the output of parse_pdf (invalidates the cache)
+PARSER_VERSION = '4'
 
+_settings = (None, None)    # (settings, digest)
 
-def get_pdfinfo(pdf_path, userpw=None):
-    try:
-        if userpw is not None:
-            proc = Popen(["pdfinfo", pdf_path, '-upw', userpw],
-                         stdout=PIPE, stderr=PIPE)
-        else:
-            proc = Popen(["pdfinfo", pdf_path], stdout=PIPE, stderr=PIPE)
-
-        out, err = proc.communicate()
-    except:
-        raise PDFInfoNotInstalledError(('Unable to get page count. ' +
-                                        'Is poppler installed and in PATH?'))
-
-    try:
-
-        data = out.decode("utf8", "ignore")
-        pdfinfo = {
-            'title': regex_srch(data, 'Title:'),
-            'creator': regex_srch(data, 'Creator:'),
-            'producer': regex_srch(data, 'Producer:'),
-            'tragged': regex_srch(data, 'Tagged:'),
-            'user_properties': regex_srch(data, 'UserProperties:'),
-            'suspects': regex_srch(data, 'Suspects:'),
-            'from': regex_srch(data, 'Form:'),
-            'javascript': regex_srch(data, 'JavaScript:'),
-            'pages': utils.input2num(regex_srch(data, 'Pages:')),
-            'encripted': regex_srch(data, 'Encrypted:'),
-            'page_size': regex_srch(data, 'Page size:'),
-            'page_rot': regex_srch(data, 'Page rot:'),
-            'file_size': regex_srch(data, 'File size:'),
-            'optimized': regex_srch(data, 'Optimized:'),
-            'pdf_version': regex_srch(data, 'PDF version:'),
-            'creation_date': regex_srch(data, 'CreationDate:'),
-            'author': regex_srch(data, 'Author:')
-        }
-        return pdfinfo
-    except:
-        raise PDFPageCountError('Unable to get pdf info. %s' % err.decode("utf8", "ignore"))
+
+def cache_key(raw_hash):
+    '''
+    Key of the parse of a file in the parse cache: its raw hash, the
+    parser version and a digest of the settings the output depends on,
+    so editing the exclude words or the config is not served stale parses.
+    '''
+    global _settings
+    exclude_re = cleaner.get_exclude_words().pattern
+    settings = (exclude_re.pattern if exclude_re is not None else None,
+                config.get('parser', {}).get('extractor', 'auto'),
+                config.get('summary', {}).get('scoring', 'tf'),
+                config.get('sentiment', {}).get('backend', 'vader'))
+    if settings != _settings[0]:
+        digest = hashlib.sha1(repr(settings).encode('utf-8')).hexdigest()[:12]
+        _settings = (settings, digest)
+    return '{}-{}-{}'.format(raw_hash, PARSER_VERSION, _settings[1])
+
+
+def _task_name():
+    '''Greenlet running the parse, or the worker process: the main
+    greenlet of a pool worker has no name'''
+    return getattr(gevent.getcurrent(), 'name', None) or \
+        'pid {}'.format(os.getpid())
 
 
 @decfun
@@ -81,82 +55,86 @@ def parse_pdf(root, file_name, file_extension, folder='', encoding='utf-8'):
     content = {}
     file_path = os.path.join(root, folder, file_name+file_extension)
     logger.debug('Gevent (init parse_pdf): {}. File: {}'.
-                 format(gevent.getcurrent().name, file_path))
+                 format(_task_name(), file_path))
 
     status = 'error'
     clean_text = ''
     content = {}
-    exclude_sent_with_words = []
-    
-    file_exc_words = './exclude_words.txt'
-    if os.path.isfile(file_exc_words):
-        exclude_sent_with_words = utils.read_txt_file(file_exc_words)
-        
     
     if file_extension != '.pdf':
         logger.error("File extension of '{}' is not '.pdf'".format(file_path))
 
     else:
 
-        eof = subprocess.check_output(['tail', '-n', '1', file_path])
-        # %%EOF, %%EOF\n, %%EOF\r, %%EOF\r\n
-        eof = eof.replace(b'\r', b'')
-        eof = eof.replace(b'\n', b'')
-        if (b'%%EOF' in eof[-4:]):
-            logger.error("Error reading EOF bytes '{}' from '{}'".
-                    format(eof.decode('utf-8'), file_path))
+        with metrics.STEP_SECONDS.time('eof_check'):
+            check, msg = pdfcheck.check_pdf(
+                file_path,
+                strict=config.get('parser', {}).get('strict_xref', False))
+        if check != pdfcheck.OK:
+            logger.error("Invalid PDF '{}': {}".format(file_path, msg))
         else:
+            if msg:
+                logger.debug("PDF '{}': {}".format(file_path, msg))
 
             t1 = time()
             
-            pdfinfo = get_pdfinfo(file_path)
-            numpages = pdfinfo.get('pages', -1)
-            
-            logger.debug('Gevent (before textract.process): {}'.
-                         format(gevent.getcurrent().name))
+            logger.debug('Gevent (before extract): {}'.
+                         format(_task_name()))
+            stream_pages = config.get('parser', {}).get('stream_pages')
             try:
-                text = textract.process(file_path, encoding=encoding)
+                pdfinfo, raw_pieces = extractors.open_pdf(
+                    file_path, encoding=encoding, stream_pages=stream_pages)
+                numpages = pdfinfo.get('pages', -1)
+                streaming = bool(stream_pages) and numpages > stream_pages
+
+                exclude_re = cleaner.get_exclude_words().pattern
+                pieces = (utils.remove_non_printable_chars(piece)
+                          for piece in raw_pieces)
+
+                hash_object = hashlib.sha512()
+                if streaming:
+                    # page by page, only the clean text is kept in memory
+                    logger.info("Streaming '{}' ({} pages)".
+                                format(file_path, numpages))
+                    clean_parts = []
+                    t2 = perf_counter()
+                    for piece in cleaner.clean_stream(pieces, numpages,
+                                                      exclude_re):
+                        hash_object.update(piece.encode(encoding))
+                        clean_parts.append(piece)
+                    clean_text = ''.join(clean_parts)
+                    del clean_parts
+                    # without the time spent reading the pages
+                    metrics.STEP_SECONDS.observe(
+                        perf_counter() - t2 - getattr(raw_pieces, 'elapsed', 0),
+                        'clean')
+                else:
+                    text = ''.join(pieces).split('\n')
+                    with metrics.STEP_SECONDS.time('clean'):
+                        clean_text = cleaner.clean_lines(text, numpages,
+                                                         exclude_re)
+                    del text
+                    hash_object.update(clean_text.encode(encoding))
 
             except:
-                logger.error(("Unexpected error while parsing PDF file_path '{}' " +
-                              "using textract").format(file_path))
+                logger.error("Unexpected error while parsing PDF file_path '{}'".
+                             format(file_path))
                 return {'status': status, 'args': file_path, 'data': content}
 
-            logger.debug('Gevent (after textract.process: {} - {}'.
-                         format(gevent.getcurrent().name, time() - t1))
-
-            text = text.decode("utf-8")
-            text = utils.remove_non_printable_chars(text)
-            text = text.split('\n')
-
-            for line in text:
-                if not line and clean_text[-2:] != '\n\n':
-                    clean_text += '\n'
-                else:
-                    if "disclosure" in line.lower(): break
-                    for exc_words in exclude_sent_with_words:
-                        if '@' in line.lower(): break
-                        if re.search(r'\b' + exc_words.lower().replace('+','\+') + r'\b', line.lower()): break
-                    else:
-                        if text.count(line) <= max(numpages-10, 4):
-                            #remove extra spaces
-                            clean_line = re.sub(r'\s+', ' ', line)
-                            clean_line = utils.remove_nonsense_lines(str(clean_line), 6)
-                            if clean_line:
-                                clean_text += clean_line + '\n'
+            logger.debug('Gevent (after extract: {} - {}'.
+                         format(_task_name(), time() - t1))
 
             if not clean_text:
-                logger.error(("textract was unable to parse " +
+                logger.error(("The extractor was unable to parse " +
                               "the contents of the document '{}'").
                               format(file_path))
                 return {'status': status, 'args': file_path, 'data': content}
 
-            summary, freq_words, sentiment = text_summary(clean_text, 20)
+            metrics.BYTES.inc('text', amount=len(clean_text))
+            with metrics.STEP_SECONDS.time('summary'):
+                summary, freq_words, sentiment = text_summary(clean_text, 20)
             tags = list(freq_words)[:5] if len(freq_words)>5 else list(freq_words)
             
-            clean_text_bytes = bytes(clean_text, encoding=encoding)
-            clean_text_b64str = base64.b64encode(clean_text_bytes).decode('utf-8')
-            hash_object = hashlib.sha512(clean_text_bytes)
             hex_dig = hash_object.hexdigest()
             
             content = {
@@ -169,7 +147,6 @@ def parse_pdf(root, file_name, file_extension, folder='', encoding='utf-8'):
                     **pdfinfo
                 },
                 'content': clean_text,
-                'content_base64': clean_text_b64str,
                 'summary': summary,
                 'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                 'tags': tags,
@@ -177,7 +154,7 @@ def parse_pdf(root, file_name, file_extension, folder='', encoding='utf-8'):
             }
 
             logger.debug('Gevent (end parse_pdf): {} - {}'.
-                         format(gevent.getcurrent().name, time() - t0))
+                         format(_task_name(), time() - t0))
 
             if not content:
                 status = 'error'
@@ -189,20 +166,10 @@ def parse_pdf(root, file_name, file_extension, folder='', encoding='utf-8'):
 
 
 @decfun
-def parse_pdf2img(filename, folder_img):
-    try:
-        with tempfile.TemporaryDirectory() as tmppath:
-            images = convert_from_path(filename, dpi=80, fmt='jpeg', strict=False,
-                           last_page=10, output_folder=tmppath)
-
-            utils.create_directory(folder_img)
-            files = os.listdir(tmppath)
-            for file in files:
-                src = os.path.join(tmppath, file)
-                shutil.move(src, folder_img)
-        return True
-    except:
-        logger.error(("pdf2image could not convert " +
-                          " the document '{}'").format(filename))
+def parse_pdf2img(filename, folder_img, npages=-1):
+    written = thumbnails.get_renderer().render(filename, folder_img, npages)
+    if not written:
+        logger.error(("Could not render the thumbnails of " +
+                      " the document '{}'").format(filename))
         return False
-
+    return True
@@ -0,0 +1,63 @@
+import os
+import re
+import mmap
+
+
+HEAD_BYTES = 1024
+TAIL_BYTES = 4096   # %%EOF must be in the last 1024 bytes; allow some junk
+
+re_xref = re.compile(rb'\s*(xref|\d+\s+\d+\s+obj)')
+
+# results of check_pdf
+OK = 'ok'
+EMPTY = 'empty'
+NOT_PDF = 'not_pdf'
+TRUNCATED = 'truncated'
+NO_STARTXREF = 'no_startxref'
+BAD_XREF = 'bad_xref'
+
+
+def check_pdf(pdf_path, strict=False):
+    '''
+    Validate the structure of a PDF reading only its first and last few KB
+    (memory mapped): '%PDF-' header, '%%EOF' marker, 'startxref' and, with
+    strict=True, that the xref offset points to an xref table or stream.
+    Many readers repair bad offsets, so by default a bad one is reported
+    but not fatal.
+
+    Returns (result, message), result being one of the constants above.
+    '''
+
+    size = os.path.getsize(pdf_path)
+    if size == 0:
+        return EMPTY, 'empty file'
+
+    with open(pdf_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if b'%PDF-' not in mm[:HEAD_BYTES]:
+                return NOT_PDF, 'missing %PDF- header'
+
+            tail_start = max(size - TAIL_BYTES, 0)
+            tail = mm[tail_start:]
+
+            eof = tail.rfind(b'%%EOF')
+            if eof < 0:
+                return TRUNCATED, 'missing %%EOF marker'
+
+            startxref = tail.rfind(b'startxref', 0, eof)
+            if startxref < 0:
+                return NO_STARTXREF, 'missing startxref'
+
+            try:
+                offset = int(tail[startxref + 9:eof].split()[0])
+            except (ValueError, IndexError):
+                return BAD_XREF, 'unreadable startxref offset'
+
+            if offset >= size or not re_xref.match(mm[offset:offset + 64]):
+                msg = 'startxref offset {} is not an xref'.format(offset)
+                return (BAD_XREF, msg) if strict else (OK, msg)
+        finally:
+            mm.close()
+
+    return OK, ''
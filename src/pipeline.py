@@ -0,0 +1,196 @@
+from gevent import monkey
+monkey.patch_all()
+import gevent
+from gevent.queue import Queue, Empty
+from time import time
+import metrics
+from control import logger
+
+
+class _Stop():
+    '''Sentinel closing a stage inbox'''
+    pass
+
+STOP = _Stop()
+
+
+class Stage():
+    '''
+    A step of the pipeline. `workers` greenlets take items from the inbox,
+    call fn(item) and put the returned item in the inbox of the next stage.
+    fn returning None drops the item.
+
+    With batch_size > 1 fn receives a list of up to batch_size items,
+    collected for at most batch_secs, and returns the list of items to
+    forward.
+    '''
+
+    def __init__(self, name, fn, workers=1, maxsize=None, batch_size=1,
+                 batch_secs=1.0):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_secs = batch_secs
+        self.inbox = Queue(maxsize)
+        self.next = None
+        self.greenlets = []
+        self._alive = 0
+
+        # counters
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.max_queue = 0
+        self.t_start = None
+        self._seconds = metrics.STAGE_SECONDS.labels(name)
+        self._items = metrics.ITEMS.labels(name)
+        self._errors = metrics.ERRORS.labels(name)
+
+    def start(self):
+        self.t_start = time()
+        self._alive = self.workers
+        self.greenlets = [gevent.spawn(self._work) for _ in range(self.workers)]
+
+    def put(self, item):
+        self.inbox.put(item)  # blocks when full (backpressure)
+        self.max_queue = max(self.max_queue, self.inbox.qsize())
+
+    def close(self):
+        for _ in range(self.workers):
+            self.inbox.put(STOP)
+
+    def _get_batch(self):
+        '''Up to batch_size items. The second value is False once STOP
+        was received.'''
+        batch = []
+        item = self.inbox.get()
+        deadline = time() + self.batch_secs
+        while item is not STOP:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, True
+            try:
+                item = self.inbox.get(timeout=max(deadline - time(), 0))
+            except Empty:
+                return batch, True
+        return batch, False
+
+    def _call(self, items):
+        t1 = time()
+        try:
+            if self.batch_size > 1:
+                out = self.fn(items) or []
+            else:
+                out = [self.fn(items[0])]
+        except Exception as ex:
+            self.errors += len(items)
+            self._errors.inc(len(items))
+            logger.error("Stage '{}' failed: {}".format(self.name, str(ex)))
+            out = []
+        elapsed = time() - t1
+        self.busy += elapsed
+        self.processed += len(items)
+        self._seconds.observe(elapsed)
+        self._items.inc(len(items))
+
+        out = [item for item in out if item is not None]
+        self.dropped += len(items) - len(out)
+        if self.next:
+            for item in out:
+                self.next.put(item)
+
+    def _work(self):
+        running = True
+        while running:
+            if self.batch_size > 1:
+                items, running = self._get_batch()
+            else:
+                items = [self.inbox.get()]
+                running = items[0] is not STOP
+                if not running:
+                    items = []
+            if items:
+                self._call(items)
+
+        # the last worker out closes the next stage
+        self._alive -= 1
+        if self._alive == 0 and self.next:
+            self.next.close()
+
+    def stats(self):
+        elapsed = max(time() - (self.t_start or time()), 1e-6)
+        return {'processed': self.processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'queue': self.inbox.qsize(),
+                'max_queue': self.max_queue,
+                'rate': round(self.processed / elapsed, 2),
+                'busy': round(self.busy / (elapsed * self.workers), 2)}
+
+
+class Pipeline():
+    '''
+    Stages connected by bounded queues. Every stage runs continuously;
+    a slow stage fills its inbox and blocks the stages before it.
+    '''
+
+    def __init__(self, stages, maxsize=50):
+        self.stages = stages
+        for stage in stages:
+            if stage.inbox.maxsize is None:
+                stage.inbox = Queue(maxsize)
+        for prev, stage in zip(stages, stages[1:]):
+            prev.next = stage
+        self._monitor = None
+
+    def start(self, status_secs=None):
+        for stage in self.stages:
+            stage.start()
+        if status_secs:
+            self._monitor = gevent.spawn(self._log_status, status_secs)
+        metrics.REGISTRY.add_collector(self.collect)
+        return self
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def close(self):
+        self.stages[0].close()
+
+    def join(self):
+        for stage in self.stages:
+            gevent.joinall(stage.greenlets)
+        if self._monitor:
+            self._monitor.kill()
+        self.collect()
+        metrics.REGISTRY.remove_collector(self.collect)
+        self.log_status()
+
+    def run(self, items, status_secs=None):
+        self.start(status_secs)
+        for item in items:
+            self.put(item)
+        self.close()
+        self.join()
+
+    def stats(self):
+        return dict((stage.name, stage.stats()) for stage in self.stages)
+
+    def collect(self):
+        '''Stage gauges of the metrics registry'''
+        for stage in self.stages:
+            stats = stage.stats()
+            metrics.QUEUE.set(stats['queue'], stage.name)
+            metrics.RATE.set(stats['rate'], stage.name)
+            metrics.BUSY.set(stats['busy'], stage.name)
+
+    def log_status(self):
+        for stage in self.stages:
+            logger.info("Stage '{}' >> {}".format(stage.name, stage.stats()))
+
+    def _log_status(self, sec):
+        while True:
+            gevent.sleep(sec)
+            self.log_status()
@@ -0,0 +1,210 @@
+import os
+import re
+import stat
+import sqlite3
+from config import config
+from control import logger
+
+
+re_bad_chars = re.compile(r'[^a-zA-Z0-9\.]')
+
+
+def normalise_name(name):
+    '''The name utils.replace_recursively gives to a file or folder'''
+    return re_bad_chars.sub('_', name)
+
+
+def file_entry(root, directory, filename):
+    '''Same shape as the items of utils.files_in_dir_recursively'''
+    folder = os.path.relpath(directory, root)
+    if folder == '.':
+        folder = ''
+    dot = filename.find('.') if filename.find('.') >= 0 else 0
+    return {'root': root,
+            'folder': folder,
+            'fname': filename[:dot],
+            'fext': filename[dot:]}
+
+
+class FileState():
+    '''
+    (size, mtime, inode) of every file found under the scanned roots, kept
+    in SQLite so a scan only yields the files that are new, changed or not
+    handled yet. Rows are read and written one directory at a time, so an
+    unchanged tree costs one scandir and one stat per file and no writes.
+
+    A yielded file stays pending, and is yielded again by the next scan,
+    until done() is called for it (handled, leave it where it is) or it is
+    moved away and forget() removes it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                        '(dir TEXT, name TEXT, size INTEGER, mtime INTEGER, '
+                        'inode INTEGER, done INTEGER, '
+                        'PRIMARY KEY (dir, name))')
+        self.db.commit()
+
+    def scan(self, root, extension=None, exclude_dir=None, rename=True,
+             top=None):
+        '''
+        Yield the new or changed files under root, or only under its
+        folder top. With rename, the names of the new files and folders
+        are normalised first, as utils.replace_recursively did for the
+        whole tree.
+        '''
+
+        if not root or not os.path.isdir(root):
+            raise ValueError("root does not exist")
+        root = os.path.abspath(root)
+        if exclude_dir:
+            exclude_dir = os.path.abspath(exclude_dir)
+
+        top = os.path.abspath(top) if top else root
+        if top != root and rename:
+            top = self._normalise(*os.path.split(top))
+
+        visited = set()
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            visited.add(directory)
+            known = dict((row[0], row[1:]) for row in self.db.execute(
+                'SELECT name, size, mtime, inode, done FROM files '
+                'WHERE dir = ?', (directory,)))
+
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as ex:
+                logger.error("Error scanning '{}': {}".format(directory, str(ex)))
+                continue
+
+            subdirs = []
+            changed = []
+            present = set()
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if (exclude_dir and
+                                os.path.abspath(entry.path) == exclude_dir):
+                            continue
+                        path = self._normalise(directory, entry.name) \
+                            if rename else entry.path
+                        subdirs.append(path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if extension and not entry.name.endswith(extension):
+                        continue
+                    name = entry.name
+                    st = entry.stat()
+                except OSError:
+                    continue
+
+                state = (st.st_size, st.st_mtime_ns, st.st_ino)
+                if name in known and known[name][:3] == state:
+                    present.add(name)
+                    if not known[name][3]:
+                        changed.append((name, state))
+                    continue
+
+                if rename and name not in known:
+                    new_name = os.path.basename(
+                        self._normalise(directory, name))
+                    if new_name != name:
+                        name = new_name
+                present.add(name)
+                changed.append((name, state))
+
+            with self.db:
+                gone = [(directory, name) for name in known if name not in present]
+                self.db.executemany('DELETE FROM files WHERE dir = ? AND name = ?',
+                                    gone)
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, 0)',
+                    [(directory, name) + state for name, state in changed])
+
+            for name, _ in changed:
+                yield file_entry(root, directory, name)
+
+            # os.walk order, folders in the order they were listed
+            stack.extend(reversed(subdirs))
+
+        self._drop_missing_dirs(top, visited)
+
+    def check(self, root, path, rename=True):
+        '''scan() of a single file: its entry if new, changed or pending'''
+
+        root = os.path.abspath(root)
+        directory, name = os.path.split(os.path.abspath(path))
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        state = (st.st_size, st.st_mtime_ns, st.st_ino)
+        row = self.db.execute('SELECT size, mtime, inode, done FROM files '
+                              'WHERE dir = ? AND name = ?',
+                              (directory, name)).fetchone()
+        if row and tuple(row[:3]) == state and row[3]:
+            return None
+
+        if rename and row is None:
+            name = os.path.basename(self._normalise(directory, name))
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO files '
+                            'VALUES (?, ?, ?, ?, ?, 0)',
+                            (directory, name) + state)
+        return file_entry(root, directory, name)
+
+    def _normalise(self, directory, name):
+        new_name = normalise_name(name)
+        path = os.path.join(directory, name)
+        if new_name == name:
+            return path
+        new_path = os.path.join(directory, new_name)
+        try:
+            os.rename(path, new_path)
+        except OSError as ex:
+            logger.error("Error renaming '{}': {}".format(path, str(ex)))
+            return path
+        return new_path
+
+    def _drop_missing_dirs(self, root, visited):
+        prefix = os.path.join(root, '')
+        stale = [row[0] for row in self.db.execute('SELECT DISTINCT dir FROM files')
+                 if (row[0] == root or row[0].startswith(prefix)) and
+                 row[0] not in visited]
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE dir = ?',
+                                [(d,) for d in stale])
+
+    def done(self, path):
+        '''Do not yield path again until it changes'''
+        with self.db:
+            self.db.execute('UPDATE files SET done = 1 WHERE dir = ? AND name = ?',
+                            os.path.split(os.path.abspath(path)))
+
+    def forget(self, path):
+        '''Drop the state of path, it is yielded again if still there'''
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE dir = ? AND name = ?',
+                            os.path.split(os.path.abspath(path)))
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM files')
+
+
+_file_state = None
+
+
+def get_file_state():
+    global _file_state
+    if _file_state is None:
+        _file_state = FileState(config['scanner']['state_path'])
+    return _file_state
@@ -0,0 +1,116 @@
+import math
+import sqlite3
+from config import config
+
+np = None
+
+
+def numpy():
+    '''numpy, imported on first use. None when not installed'''
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            return None
+    return np
+
+
+class IdfTable():
+    '''
+    Document frequency of every stem over all the documents summarised,
+    persisted in SQLite and shared by the worker processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS df '
+                        '(stem TEXT PRIMARY KEY, n INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS docs (n INTEGER)')
+        if self.db.execute('SELECT COUNT(*) FROM docs').fetchone()[0] == 0:
+            self.db.execute('INSERT INTO docs VALUES (0)')
+        self.db.commit()
+
+    def add_document(self, stems):
+        '''Count a document with these (distinct) stems'''
+        with self.db:
+            self.db.execute('UPDATE docs SET n = n + 1')
+            self.db.executemany('INSERT OR IGNORE INTO df VALUES (?, 0)',
+                                [(s,) for s in stems])
+            self.db.executemany('UPDATE df SET n = n + 1 WHERE stem = ?',
+                                [(s,) for s in stems])
+
+    def idf(self, stems):
+        '''Smoothed idf, log((1 + N) / (1 + df)) + 1, of every stem'''
+        ndocs = self.db.execute('SELECT n FROM docs').fetchone()[0]
+        df = {}
+        for i in range(0, len(stems), 500):
+            chunk = stems[i:i + 500]
+            rows = self.db.execute(
+                'SELECT stem, n FROM df WHERE stem IN ({})'.
+                format(','.join('?' * len(chunk))), chunk)
+            df.update(rows)
+        return [math.log((1 + ndocs) / (1 + df.get(s, 0))) + 1 for s in stems]
+
+
+_idf_table = None
+
+
+def get_idf_table():
+    global _idf_table
+    if _idf_table is None:
+        _idf_table = IdfTable(config['summary']['idf_path'])
+    return _idf_table
+
+
+def score_vector(sentences, sentence_stems, sentence_counted, idf_table=None):
+    '''
+    Same scores as text_summary.score_sentences computed with NumPy:
+    stems are mapped to integer ids, the (sentence, term) pairs of the
+    sentences with 4 to 30 words form a sparse count matrix, and the scores
+    are its product with the term frequencies (times the idf when an
+    IdfTable is given, which also records the document).
+
+    Returns (unique sentences, scores array, tokens_frequencies).
+    '''
+
+    np = numpy()
+    vocab = {}
+    unique = {}
+    rows, cols, counted = [], [], []
+    for sent, stems, flags in zip(sentences, sentence_stems, sentence_counted):
+        ids = [vocab.setdefault(s, len(vocab)) for s in stems]
+        counted.extend(i for i, flag in zip(ids, flags) if flag)
+
+        row = unique.setdefault(sent, len(unique))
+        nwords = len(sent.split())
+        if nwords <= 30 and nwords >= 4:
+            rows.extend([row] * len(ids))
+            cols.extend(ids)
+
+    tf = np.bincount(np.asarray(counted, dtype=np.int64), minlength=len(vocab))
+
+    weights = tf.astype(np.float64)
+    stems = list(vocab)
+    if idf_table is not None and stems:
+        weights *= np.asarray(idf_table.idf(stems))
+        idf_table.add_document(stems)
+
+    scores = np.bincount(np.asarray(rows, dtype=np.int64),
+                         weights=weights[np.asarray(cols, dtype=np.int64)],
+                         minlength=len(unique))
+
+    # stems by first counted occurrence, then most frequent first
+    order = dict.fromkeys(counted)
+    tokens_frequencies = dict(sorted(((stems[i], int(tf[i])) for i in order),
+                                     key=lambda kv: kv[1], reverse=True))
+
+    return list(unique), scores, tokens_frequencies
+
+
+def top_n(sentences, scores, n):
+    '''The n best sentences, ties in text order as heapq.nlargest does'''
+    np = numpy()
+    best = np.argsort(-scores, kind='stable')[:n]
+    return [sentences[i] for i in best]
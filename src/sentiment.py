@@ -0,0 +1,136 @@
+from gevent import monkey
+monkey.patch_all()
+import gevent
+import json
+from config import config
+from control import logger
+
+
+def _result(sentence, label=None, neg=None, neutral=None, pos=None):
+    '''Shape of the 'sentiment' field of the 'files' mapping'''
+    result = {'sentence': sentence}
+    if label is not None:
+        result['label'] = label
+        result['probability'] = {'neg': neg, 'neutral': neutral, 'pos': pos}
+    return result
+
+
+class SentimentBackend():
+    '''score() returns one result per sentence, in order'''
+
+    name = None
+
+    def score(self, sentences):
+        raise NotImplementedError
+
+
+class VaderSentiment(SentimentBackend):
+    '''
+    In process scoring with NLTK's VADER lexicon. Labels follow the usual
+    compound thresholds (+-0.05); 'pos'/'neg' are the compound score mapped
+    to [0, 1] and 'neutral' the neutral share of the sentence.
+    '''
+
+    name = 'vader'
+
+    def __init__(self):
+        self._analyzer = None
+        self._missing = False
+
+    @property
+    def analyzer(self):
+        '''The lexicon is read from the nltk data path, never downloaded:
+        hosts without internet access would hang on it'''
+        if self._analyzer is None:
+            import nltk
+            from nltk.sentiment.vader import SentimentIntensityAnalyzer
+            try:
+                nltk.data.find('sentiment/vader_lexicon.zip')
+            except LookupError:
+                raise LookupError(
+                    "VADER lexicon not found in {}. Install it with "
+                    "'python -m nltk.downloader vader_lexicon' or point "
+                    "NLTK_DATA to a copy".format(', '.join(nltk.data.path)))
+            self._analyzer = SentimentIntensityAnalyzer()
+        return self._analyzer
+
+    def score(self, sentences):
+        try:
+            if self._missing:
+                raise LookupError
+            analyzer = self.analyzer
+        except LookupError as ex:
+            # as the http backend does when the API is unreachable
+            if not self._missing:
+                logger.error('{}. Sentences not scored'.format(str(ex)))
+            self._missing = True
+            return [_result(sent) for sent in sentences]
+
+        results = []
+        for sent in sentences:
+            scores = analyzer.polarity_scores(sent)
+            compound = scores['compound']
+            if compound >= 0.05:
+                label = 'pos'
+            elif compound <= -0.05:
+                label = 'neg'
+            else:
+                label = 'neutral'
+            pos = round((compound + 1) / 2, 4)
+            results.append(_result(sent, label, round(1 - pos, 4),
+                                   scores['neu'], pos))
+        return results
+
+
+class HttpSentiment(SentimentBackend):
+    '''text-processing.com style API, one request per sentence sent
+    concurrently over a pooled session'''
+
+    name = 'http'
+
+    def __init__(self, url, timeout=5, pool_size=20):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _post(self, sent):
+        result = {}
+        try:
+            r = self.session.post(self.url, {'text': sent}, timeout=self.timeout)
+            if r.status_code == 200:
+                result = json.loads(r.content.decode())
+        except Exception as ex:
+            logger.error("Sentiment request failed: {}".format(str(ex)))
+        result["sentence"] = sent
+        return result
+
+    def score(self, sentences):
+        g1 = [gevent.spawn(self._post, sent) for sent in sentences]
+        gevent.joinall(g1)
+        return [g.value for g in g1]
+
+
+_backend = None
+
+
+def get_backend():
+    '''Process wide backend from config['sentiment']'''
+    global _backend
+    if _backend is None:
+        conf = config.get('sentiment', {})
+        name = conf.get('backend', 'vader')
+        if name == 'vader':
+            _backend = VaderSentiment()
+        elif name == 'http':
+            _backend = HttpSentiment(conf['url'], conf.get('timeout', 5),
+                                     conf.get('pool_size', 20))
+        else:
+            raise ValueError("Unknown sentiment backend '{}'. Valid: vader, http".
+                             format(name))
+    return _backend
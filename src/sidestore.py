@@ -0,0 +1,74 @@
+import os
+import gzip
+import base64
+from config import config
+import utils
+
+
+class SideStore():
+    '''
+    Compressed copies of the documents content kept on disk, out of the
+    Elasticsearch index, referenced by meta.content_sha512_hex.
+    '''
+
+    def __init__(self, directory, encoding='utf-8'):
+        self.directory = directory
+        self.encoding = encoding
+        utils.create_directory(directory)
+
+    def path(self, hex_dig):
+        return os.path.join(self.directory, hex_dig[:2], hex_dig + '.gz')
+
+    def __contains__(self, hex_dig):
+        return os.path.isfile(self.path(hex_dig))
+
+    def put(self, hex_dig, text):
+        path = self.path(hex_dig)
+        if os.path.isfile(path):    # content addressed, never changes
+            return path
+        utils.create_directory(os.path.dirname(path))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(gzip.compress(text.encode(self.encoding)))
+        os.replace(tmp, path)
+        return path
+
+    def get(self, hex_dig):
+        try:
+            with open(self.path(hex_dig), 'rb') as f:
+                return gzip.decompress(f.read()).decode(self.encoding)
+        except OSError:
+            return None
+
+    def get_base64(self, hex_dig):
+        '''The value content_base64 had in the index'''
+        text = self.get(hex_dig)
+        if text is None:
+            return None
+        return base64.b64encode(text.encode(self.encoding)).decode('utf-8')
+
+
+_side_store = None
+
+
+def get_side_store():
+    global _side_store
+    if _side_store is None:
+        _side_store = SideStore(config['base64']['dir'])
+    return _side_store
+
+
+def add_base64(doc):
+    '''
+    Apply config['base64']['mode'] to a document before storing it:
+        'off'    no base64 copy (default)
+        'index'  content_base64 stored in the index, as it used to be
+        'disk'   compressed copy in the side store
+    '''
+    mode = config.get('base64', {}).get('mode', 'off')
+    if mode == 'index':
+        doc['content_base64'] = base64.b64encode(
+            doc['content'].encode('utf-8')).decode('utf-8')
+    elif mode == 'disk':
+        get_side_store().put(doc['meta']['content_sha512_hex'], doc['content'])
+    return doc
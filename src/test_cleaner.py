@@ -0,0 +1,103 @@
+'''
+cleaner.clean_lines and cleaner.clean_stream give byte identical output
+to the line loop parse_pdf had before them.
+
+    python -m pytest test_cleaner.py
+'''
+import re
+import random
+import pytest
+import utils
+import cleaner
+
+
+def _clean_lines_old(text, numpages, exclude_sent_with_words):
+    # line loop of parse_pdf previous to cleaner.clean_lines
+    clean_text = ''
+    for line in text:
+        if not line and clean_text[-2:] != '\n\n':
+            clean_text += '\n'
+        else:
+            if "disclosure" in line.lower(): break
+            for exc_words in exclude_sent_with_words:
+                if '@' in line.lower(): break
+                if re.search(r'\b' + exc_words.lower().replace('+', r'\+') + r'\b', line.lower()): break
+            else:
+                if text.count(line) <= max(numpages-10, 4):
+                    #remove extra spaces
+                    clean_line = re.sub(r'\s+', ' ', line)
+                    clean_line = utils.remove_nonsense_lines(str(clean_line), 6)
+                    if clean_line:
+                        clean_text += clean_line + '\n'
+    return clean_text
+
+
+def sample_lines(nlines, rnd):
+    '''Lines of a parsed document: repeated headers, empty runs, short
+    lines, e-mails, excluded words and now and then a disclosure'''
+    headers = ['Company Research  |  Page', 'CONFIDENTIAL', 'www.broker.com']
+    words = ['market', 'growth', 'c++', 'Revenue', 'q3', 'eps', 'target',
+             'sell', 'buy', 'áé', '\t', 'x']
+    lines = []
+    for _ in range(nlines):
+        kind = rnd.random()
+        if kind < 0.15:
+            lines.append('')
+        elif kind < 0.3:
+            lines.append(rnd.choice(headers))
+        elif kind < 0.33:
+            lines.append('analyst{}@broker.com'.format(rnd.randint(0, 9)))
+        elif kind < 0.36:
+            lines.append('ab  c')
+        elif kind < 0.362:
+            lines.append('Important Disclosures')
+        else:
+            lines.append('  '.join(rnd.choice(words)
+                                   for _ in range(rnd.randint(1, 12))))
+    return lines
+
+
+EXCLUDE = ['sell', 'C++', 'rating']
+
+
+def corpus(ndocs=500, nlines=300, seed=0):
+    '''(lines, numpages, exclude words) of ndocs generated documents'''
+    rnd = random.Random(seed)
+    return [(sample_lines(nlines, rnd), rnd.choice([1, 5, 14, 20, 40]),
+             rnd.choice([EXCLUDE, []])) for _ in range(ndocs)]
+
+
+def pieces_of(lines, size):
+    text = '\n'.join(lines)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_clean_lines_as_previous_loop(seed):
+    for lines, numpages, words in corpus(seed=seed):
+        exclude_re = cleaner.compile_exclude_words(words)
+        assert (cleaner.clean_lines(lines, numpages, exclude_re) ==
+                _clean_lines_old(lines, numpages, words))
+
+
+@pytest.mark.parametrize('size', [1, 7, 700, 1 << 20])
+def test_clean_stream_as_previous_loop(size):
+    for lines, numpages, words in corpus(ndocs=100, seed=size):
+        exclude_re = cleaner.compile_exclude_words(words)
+        assert (''.join(cleaner.clean_stream(pieces_of(lines, size), numpages,
+                                             exclude_re)) ==
+                _clean_lines_old(lines, numpages, words))
+
+
+def test_disclosure_cuts_the_document():
+    lines = ['First line of text', '', '', '', 'Important Disclosures',
+             'Second line of text']
+    assert _clean_lines_old(lines, 1, []) == 'First line of text\n\n'
+    assert cleaner.clean_lines(lines, 1, None) == 'First line of text\n\n'
+
+
+def test_repeated_lines_are_dropped():
+    lines = ['Header of the page', 'Body text number {}'] * 6
+    lines = [line.format(i) for i, line in enumerate(lines)]
+    assert cleaner.clean_lines(lines, 1, None) == _clean_lines_old(lines, 1, [])
+    assert 'Header' not in cleaner.clean_lines(lines, 1, None)
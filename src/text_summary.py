@@ -4,37 +4,58 @@ from gevent import monkey
 monkey.patch_all()
 import re
 import sys
-import nltk
-from nltk.tokenize import RegexpTokenizer, sent_tokenize
-from nltk.corpus import stopwords
-from nltk.stem.snowball import SnowballStemmer
 from subprocess import Popen, PIPE
-import bs4 as bs
-import gevent
-import requests
 import heapq
-import textwrap
-import textract
+import functools
+from collections import Counter
 import utils
-import json
-from audioop import reverse
+import sentiment
+import metrics
+import scoring as scoring_engine
+from config import config
+from control import logger
 
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
 
-try:
-    nltk.data.find('corpora/stopwords')
-except LookupError:
-    nltk.download('stopwords')
+# nltk and its data are loaded on first use (see nltk_resources), so
+# importing this module stays cheap for every spawned worker
+_nltk = {}
 
-stopwords = stopwords.words('english')
-tokenizer = RegexpTokenizer(r'\w+')
-stemmer = SnowballStemmer('english')
+
+def nltk_resources():
+    '''tokenizer, stemmer, stopwords (a frozenset) and sent_tokenize'''
+    if not _nltk:
+        import nltk
+        from nltk.tokenize import RegexpTokenizer, sent_tokenize
+        from nltk.stem.snowball import SnowballStemmer
+
+        try:
+            nltk.data.find('tokenizers/punkt')
+        except LookupError:
+            nltk.download('punkt')
+
+        try:
+            nltk.data.find('corpora/stopwords')
+        except LookupError:
+            nltk.download('stopwords')
+
+        from nltk.corpus import stopwords
+
+        _nltk.update({
+            'tokenizer': RegexpTokenizer(r'\w+'),
+            'stemmer': SnowballStemmer('english'),
+            'stopwords': frozenset(stopwords.words('english')),
+            'sent_tokenize': sent_tokenize
+        })
+    return _nltk
+
+
+# distinct words whose stem is kept in memory
+STEM_CACHE_SIZE = 200000
 
 
 def fetch_url(url):
+    import requests
+    import bs4 as bs
 
     res = requests.get(url)
 
@@ -67,6 +88,7 @@ def get_pdfinfo(pdf_path):
 
 
 def read_pdf_file(filename, exclude_sent_with_words=[]):
+    import textract
     clean_text = ''
     text = textract.process(filename, encoding='utf-8')
     text = text.decode("utf-8")
@@ -102,62 +124,111 @@ def read_txt_file(fname):
 
     return content
 
-def send_post_request(url, sent):
-    result = {}
-    r = requests.post(url, {'text': sent})
-    if r.status_code == 200:
-        result = json.loads(r.content.decode())
-    result["sentence"] = sent
-    return result 
 
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    '''SnowballStemmer.stem memoised across the documents of a worker'''
+    return nltk_resources()['stemmer'].stem(word)
 
-def text_summary(text, numlines=7, lang='english'):
 
-    # Preprocessing
-    text = re.sub('\s+', ' ', text)
+def tokenize_sentences(sentences):
+    '''
+    Tokenise every sentence once. Returns, per sentence, the stems of its
+    words and whether each one counts for the document frequencies (it is
+    not a stop word).
+    '''
+    tokenizer = nltk_resources()['tokenizer']
+    stopwords = nltk_resources()['stopwords']
+    sentence_stems = []
+    sentence_counted = []
+    for sent in sentences:
+        words = [w.lower() for w in tokenizer.tokenize(sent) if w.isalpha()]
+        sentence_stems.append([stem(w) for w in words])
+        sentence_counted.append([w not in stopwords for w in words])
+    return sentence_stems, sentence_counted
 
-    # tokenize and form nltk objects
-    tokens = nltk.Text(tokenizer.tokenize(text))
 
-    # remove punctuations and digits and change to lower case
-    tokens = [w.lower() for w in tokens if w.isalpha() and not w.isdigit()]
+def score_sentences(text):
+    '''
+    Returns (sentences, sentence_scores, tokens_frequencies): the sentences
+    of the text, the sum of the document frequencies of the stems of each
+    sentence with 4 to 30 words, and the frequency of every stem (stop
+    words excluded), most frequent first.
+    '''
 
-    # remove stop words and stem the words
-    tokens = [stemmer.stem(w) for w in tokens if w not in stopwords]
+    # split document into sentences
+    sentences = nltk_resources()['sent_tokenize'](text)
+    sentence_stems, sentence_counted = tokenize_sentences(sentences)
 
     # find word frequencies
-    tokens_frequencies = dict(nltk.FreqDist(tokens))
-    tokens_frequencies = dict(sorted(tokens_frequencies.items(), key=lambda kv: kv[1], reverse=True))
-    freq_large_tokens = dict([(k, v) for k,v in tokens_frequencies.items() if len(k)>3])
-
-    # split document into sentences
-    sentences = sent_tokenize(text)
+    tokens_frequencies = Counter()
+    for stems, counted in zip(sentence_stems, sentence_counted):
+        tokens_frequencies.update(s for s, c in zip(stems, counted) if c)
+    tokens_frequencies = dict(sorted(tokens_frequencies.items(),
+                                     key=lambda kv: kv[1], reverse=True))
 
     # calculate score for every sentence
-    sentence_scores = dict((sent,0) for sent in sentences)
-    for sent in sentences:
-        if len(sent.split()) <= 30 and len(sent.split()) >= 4:
-            # find all words in the sentence
-            words = tokenizer.tokenize(sent)
-            words = [stemmer.stem(w.lower()) for w in words if w.isalpha() and not w.isdigit()]
-
+    sentence_scores = dict((sent, 0) for sent in sentences)
+    for sent, stems in zip(sentences, sentence_stems):
+        nwords = len(sent.split())
+        if nwords <= 30 and nwords >= 4:
             # sum of term frequencies
-            for word in words:
-                sentence_scores[sent] += tokens_frequencies.get(word, 0)
+            sentence_scores[sent] += sum(tokens_frequencies.get(s, 0)
+                                         for s in stems)
 
-    summary_sentences = heapq.nlargest(numlines, sentence_scores, key=sentence_scores.get)
-    
-    g1 = []
-    capitalized_summary_sentences = []
-    url = 'http://text-processing.com/api/sentiment/'
-    for sent in summary_sentences:
-        s = sent.strip().capitalize()
-        capitalized_summary_sentences.append(s)
-        g1.append(gevent.spawn(send_post_request, url, s))
-        
-    gevent.joinall(g1)
-    
-    sentiment_sentences = [g.value for g in g1]
+    return sentences, sentence_scores, tokens_frequencies
+
+
+def best_sentences(text, numlines, scoring):
+    '''
+    Best numlines sentences and the stem frequencies.
+    scoring:
+        'loop'   python loop over the words of every sentence
+        'tf'     the same scores computed with NumPy
+        'tfidf'  NumPy, term frequencies weighted by the idf over every
+                 document summarised so far (persisted)
+    '''
+
+    if scoring != 'loop' and scoring_engine.numpy() is None:
+        logger.error("NumPy is not installed, '{}' scoring not available".
+                     format(scoring))
+        scoring = 'loop'
+
+    if scoring == 'loop':
+        _, sentence_scores, tokens_frequencies = score_sentences(text)
+        best = heapq.nlargest(numlines, sentence_scores, key=sentence_scores.get)
+        return best, tokens_frequencies
+
+    if scoring not in ('tf', 'tfidf'):
+        raise ValueError("Unknown scoring '{}'. Valid: loop, tf, tfidf".
+                         format(scoring))
+
+    sentences = nltk_resources()['sent_tokenize'](text)
+    sentence_stems, sentence_counted = tokenize_sentences(sentences)
+    idf_table = scoring_engine.get_idf_table() if scoring == 'tfidf' else None
+    unique, scores, tokens_frequencies = scoring_engine.score_vector(
+        sentences, sentence_stems, sentence_counted, idf_table)
+    return scoring_engine.top_n(unique, scores, numlines), tokens_frequencies
+
+
+def text_summary(text, numlines=7, lang='english', scoring=None):
+
+    if scoring is None:
+        scoring = config.get('summary', {}).get('scoring', 'tf')
+
+    # Preprocessing
+    text = re.sub('\s+', ' ', text)
+
+    summary_sentences, tokens_frequencies = best_sentences(text, numlines,
+                                                           scoring)
+    freq_large_tokens = dict([(k, v) for k,v in tokens_frequencies.items() if len(k)>3])
+
+    capitalized_summary_sentences = [sent.strip().capitalize()
+                                     for sent in summary_sentences]
+
+    with metrics.STEP_SECONDS.time('sentiment'):
+        sentiment_sentences = sentiment.get_backend().score(
+            capitalized_summary_sentences)
     
     summary = '\n'.join(capitalized_summary_sentences)
 
@@ -177,7 +248,6 @@ if __name__ == '__main__':
     
     summary, freq, sentiment = text_summary(text, numlines)
 
-    #print('\n'.join(textwrap.wrap(summary, 80, break_long_words=False)))
     print(summary)
     print(freq)
     print(sentiment)
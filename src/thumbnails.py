@@ -0,0 +1,307 @@
+from gevent import monkey
+monkey.patch_all()
+import gevent
+import gevent.pool
+import os
+import io
+import json
+import sqlite3
+from subprocess import Popen, PIPE
+from config import config
+from cache import DiskCache
+import thumbpack
+import utils
+from control import logger
+
+
+FORMATS = {'jpeg': 'jpg', 'webp': 'webp'}
+
+# next to the images of every document, what the render service needs
+# to produce the pages not rendered at ingest
+SIDECAR = 'thumbs.json'
+
+
+class RenderError(Exception):
+    pass
+
+
+class Renderer():
+    '''
+    Page thumbnails rendered with pdftoppm, one process per page, at most
+    `workers` at a time for the whole process. Pages are read from the
+    pdftoppm stdout and written straight to their final name, or to a
+    pack (thumbpack).
+
+    fmt 'jpeg' is encoded by pdftoppm; 'webp' is rendered as PNG and
+    converted with PIL on a thread.
+    '''
+
+    def __init__(self, pages=10, dpi=80, fmt='jpeg', quality=75, workers=4):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown thumbnail format '{}'. Valid: {}".
+                             format(fmt, ', '.join(FORMATS)))
+        self.pages = pages
+        self.dpi = dpi
+        self.fmt = fmt
+        self.quality = quality
+        self.pool = gevent.pool.Pool(workers)
+
+    def page_name(self, page):
+        return 'page-{:03d}.{}'.format(page, FORMATS[self.fmt])
+
+    def render_page(self, pdf_path, page, dpi=None):
+        '''Image of page (1 based) as bytes'''
+        dpi = dpi or self.dpi
+        cmd = ['pdftoppm', '-f', str(page), '-l', str(page), '-r', str(dpi),
+               '-singlefile']
+        if self.fmt == 'jpeg':
+            cmd += ['-jpeg', '-jpegopt', 'quality={}'.format(self.quality)]
+        else:
+            cmd += ['-png']
+        try:
+            proc = Popen(cmd + [pdf_path], stdout=PIPE, stderr=PIPE)
+            out, err = proc.communicate()
+        except OSError as ex:
+            raise RenderError('pdftoppm not available: {}'.format(str(ex)))
+        if proc.returncode != 0 or not out:
+            raise RenderError('pdftoppm page {}: {}'.format(
+                page, err.decode('utf-8', 'ignore').strip()))
+
+        if self.fmt == 'webp':
+            out = gevent.get_hub().threadpool.apply(self._to_webp, (out,))
+        return out
+
+    def _to_webp(self, png):
+        from PIL import Image
+        buf = io.BytesIO()
+        with Image.open(io.BytesIO(png)) as img:
+            img.save(buf, 'WEBP', quality=self.quality)
+        return buf.getvalue()
+
+    def render_pages(self, pdf_path, npages, pages=None):
+        '''
+        The first pages (self.pages by default) of a document of npages
+        pages, rendered in parallel. Returns {page: image bytes} with the
+        pages that could be rendered.
+        '''
+        pages = self.pages if pages is None else pages
+        if npages and npages > 0:   # -1: unknown, try them all
+            pages = min(pages, int(npages))
+        if pages <= 0:
+            return {}
+
+        jobs = [self.pool.spawn(self.render_page, pdf_path, page)
+                for page in range(1, pages + 1)]
+        gevent.joinall(jobs)
+
+        images = {}
+        for page, job in zip(range(1, pages + 1), jobs):
+            if job.successful():
+                images[page] = job.value
+            else:
+                logger.error("Thumbnail of page {} of '{}' failed: {}".
+                             format(page, pdf_path, str(job.exception)))
+        return images
+
+    def write_pages(self, folder, images):
+        utils.create_directory(folder)
+        for page, data in images.items():
+            path = os.path.join(folder, self.page_name(page))
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+
+    def render(self, pdf_path, folder, npages, pages=None):
+        '''render_pages() into loose files in folder. Returns the number
+        of pages written'''
+        images = self.render_pages(pdf_path, npages, pages)
+        self.write_pages(folder, images)
+        return len(images)
+
+
+class RenderedIndex():
+    '''
+    Content hash -> folder (relative to dir_processed) with the thumbnails
+    rendered for it, so the same document is not rendered twice.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS rendered '
+                        '(hash TEXT PRIMARY KEY, folder TEXT, pages INTEGER, '
+                        'dpi INTEGER, fmt TEXT)')
+        self.db.commit()
+
+    def get(self, hex_dig):
+        row = self.db.execute('SELECT folder, pages, dpi, fmt FROM rendered '
+                              'WHERE hash = ?', (hex_dig,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('folder', 'pages', 'dpi', 'fmt'), row))
+
+    def put(self, hex_dig, folder, pages, dpi, fmt):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO rendered VALUES '
+                            '(?, ?, ?, ?, ?)', (hex_dig, folder, pages, dpi, fmt))
+
+    def delete(self, hex_dig):
+        with self.db:
+            self.db.execute('DELETE FROM rendered WHERE hash = ?', (hex_dig,))
+
+
+_renderer = None
+_rendered_index = None
+_page_cache = None
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        conf = config.get('thumbnails', {})
+        _renderer = Renderer(conf.get('pages', 10), conf.get('dpi', 80),
+                             conf.get('format', 'jpeg'), conf.get('quality', 75),
+                             conf.get('workers', 4))
+    return _renderer
+
+
+def get_rendered_index():
+    global _rendered_index
+    if _rendered_index is None:
+        _rendered_index = RenderedIndex(config['thumbnails']['index_path'])
+    return _rendered_index
+
+
+def get_page_cache():
+    global _page_cache
+    if _page_cache is None:
+        conf = config['thumbnails']
+        _page_cache = DiskCache(conf['cache_dir'],
+                                conf.get('cache_bytes', 1024 ** 3),
+                                suffix='.' + FORMATS[get_renderer().fmt])
+    return _page_cache
+
+
+def ingest_pages():
+    '''Pages rendered when a document is indexed'''
+    conf = config.get('thumbnails', {})
+    if conf.get('mode', 'eager') == 'lazy':
+        return conf.get('ingest_pages', 1)
+    return conf.get('pages', 10)
+
+
+def write_sidecar(folder, info):
+    path = os.path.join(folder, SIDECAR)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp, path)
+
+
+def read_sidecar(folder):
+    try:
+        with open(os.path.join(folder, SIDECAR)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return thumbpack.read_meta(folder)    # packed folder
+
+
+def thumbnails(pdf_path, hex_dig, npages, dir_processed, folder_img,
+               file_processed):
+    '''
+    Thumbnails of a document into dir_processed/folder_img, unless the same
+    content was already rendered with the same settings: then the folder
+    of that copy is returned instead. None when nothing could be rendered.
+
+    Only ingest_pages() pages are rendered; file_processed, the path of the
+    pdf relative to dir_processed once moved, goes to the sidecar so the
+    rest can be rendered on request (get_page).
+    '''
+    renderer = get_renderer()
+    index = get_rendered_index()
+
+    wanted = ingest_pages()
+    if npages and npages > 0:
+        wanted = min(wanted, int(npages))
+    prev = index.get(hex_dig)
+    if (prev and prev['dpi'] == renderer.dpi and prev['fmt'] == renderer.fmt and
+            prev['pages'] >= wanted and
+            os.path.isdir(os.path.join(dir_processed, prev['folder']))):
+        logger.debug("Thumbnails of '{}' already in '{}'".
+                     format(pdf_path, prev['folder']))
+        return prev['folder']
+
+    folder = os.path.join(dir_processed, folder_img)
+    images = renderer.render_pages(pdf_path, npages, pages=wanted)
+    if wanted and not images:
+        return None
+
+    info = {'hash': hex_dig,
+            'file': file_processed,
+            'pages': int(npages) if npages else -1,
+            'rendered': len(images),
+            'dpi': renderer.dpi,
+            'format': renderer.fmt}
+    utils.create_directory(folder)
+    if config.get('thumbnails', {}).get('storage', 'files') == 'pack':
+        thumbpack.write_pack(os.path.join(folder, thumbpack.PACK_NAME),
+                             images, info)
+    else:
+        renderer.write_pages(folder, images)
+        write_sidecar(folder, info)
+    index.put(hex_dig, folder_img, len(images), renderer.dpi, renderer.fmt)
+    return folder_img
+
+
+_rendering = {}     # cache key -> greenlet rendering it
+
+
+def get_page(dir_processed, folder_img, page, dpi=None):
+    '''
+    Image of a page of the document whose thumbnails are in folder_img
+    (relative to dir_processed): the file rendered at ingest when there is
+    one, otherwise rendered now and kept in the page cache, by content
+    hash, page and dpi. None when the page does not exist.
+    '''
+    renderer = get_renderer()
+    dpi = dpi or renderer.dpi
+    root = os.path.realpath(dir_processed)
+    folder = os.path.realpath(os.path.join(root, folder_img))
+    if not folder.startswith(os.path.join(root, '')) or page < 1:
+        return None
+
+    if dpi == renderer.dpi:
+        try:
+            with open(os.path.join(folder, renderer.page_name(page)), 'rb') as f:
+                return f.read()
+        except OSError:
+            data = thumbpack.read_pack(folder, page)
+            if data is not None:
+                return data
+
+    info = read_sidecar(folder)
+    if info is None or (info['pages'] > 0 and page > info['pages']):
+        return None
+
+    cache = get_page_cache()
+    key = '{}-{}-{}'.format(info['hash'], page, dpi)
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    # requests for the same page wait for a single render
+    job = _rendering.get(key)
+    if job is None:
+        pdf_path = os.path.join(root, info['file'])
+        job = renderer.pool.spawn(renderer.render_page, pdf_path, page, dpi)
+        _rendering[key] = job
+        job.link(lambda _: _rendering.pop(key, None))
+    job.join()
+    if not job.successful():
+        logger.error("Page {} of '{}' failed: {}".
+                     format(page, info['file'], str(job.exception)))
+        return None
+    if key not in cache:
+        cache.put(key, job.value)
+    return job.value
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+'''
+One file with all the page images of a document, instead of a loose
+file per page:
+
+    header   magic 'DPTP', version (u16), pages (u16), meta length (u32)
+    index    pages x (offset u64, length u32), length 0: page not rendered
+    meta     JSON, what the thumbs.json sidecar holds
+    images   the page images, back to back
+
+ThumbPack maps the file and reads a page with a single slice;
+read_pack() serves one page with two preads.
+
+    python thumbpack.py dir_processed    # pack the existing folders
+'''
+import os
+import re
+import sys
+import json
+import mmap
+import struct
+from control import logger
+
+
+MAGIC = b'DPTP'
+VERSION = 1
+PACK_NAME = 'pages.pack'
+
+HEADER = struct.Struct('<4sHHI')
+ENTRY = struct.Struct('<QI')
+
+re_page_file = re.compile(r'^page-(\d+)\.(jpg|webp)$')
+
+
+class PackError(Exception):
+    pass
+
+
+def write_pack(path, pages, meta=None):
+    '''pages: {page number (1 based): image bytes}'''
+    count = max(pages) if pages else 0
+    meta_bytes = json.dumps(meta or {}).encode('utf-8')
+
+    offset = HEADER.size + ENTRY.size * count + len(meta_bytes)
+    index = []
+    for page in range(1, count + 1):
+        length = len(pages.get(page, b''))
+        index.append(ENTRY.pack(offset if length else 0, length))
+        offset += length
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, count, len(meta_bytes)))
+        f.write(b''.join(index))
+        f.write(meta_bytes)
+        for page in range(1, count + 1):
+            f.write(pages.get(page, b''))
+    os.replace(tmp, path)   # readers never see a partial pack
+    return path
+
+
+class ThumbPack():
+    '''Read only access to a pack. Use as a context manager or close()'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.pages, self._meta_len = HEADER.unpack_from(
+                self.mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise PackError("'{}' is not a thumbnail pack".format(path))
+        except struct.error as ex:
+            self.close()
+            raise PackError("Corrupt pack '{}': {}".format(path, str(ex)))
+        except PackError:
+            self.close()
+            raise
+
+    @property
+    def meta(self):
+        start = HEADER.size + ENTRY.size * self.pages
+        try:
+            return json.loads(self.mm[start:start + self._meta_len].decode('utf-8'))
+        except ValueError as ex:
+            raise PackError("Corrupt pack '{}': {}".format(self.path, str(ex)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def location(self, page):
+        '''(offset, length) of page in the file, None if not in the pack'''
+        if page < 1 or page > self.pages:
+            return None
+        offset, length = ENTRY.unpack_from(self.mm, HEADER.size +
+                                           ENTRY.size * (page - 1))
+        if not length or offset + length > len(self.mm):
+            return None
+        return offset, length
+
+    def page(self, page):
+        '''Image bytes of page (1 based), None if not in the pack'''
+        loc = self.location(page)
+        if loc is None:
+            return None
+        offset, length = loc
+        return self.mm[offset:offset + length]
+
+
+def read_pack(folder, page):
+    '''
+    Image of page from the pack in folder, None when not there. For a
+    single page two preads are cheaper than setting up a mmap: the first
+    block holds the header and the index, the second read is the image.
+    '''
+    try:
+        fd = os.open(os.path.join(folder, PACK_NAME), os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        head = os.pread(fd, 4096, 0)
+        magic, version, pages, _ = HEADER.unpack_from(head, 0)
+        if magic != MAGIC or version != VERSION or page < 1 or page > pages:
+            return None
+        pos = HEADER.size + ENTRY.size * (page - 1)
+        if pos + ENTRY.size > len(head):
+            head = os.pread(fd, ENTRY.size, pos)
+            pos = 0
+        offset, length = ENTRY.unpack_from(head, pos)
+        if not length:
+            return None
+        data = os.pread(fd, length, offset)
+        return data if len(data) == length else None
+    except (OSError, struct.error):
+        return None
+    finally:
+        os.close(fd)
+
+
+def read_meta(folder):
+    try:
+        with ThumbPack(os.path.join(folder, PACK_NAME)) as pack:
+            return pack.meta
+    except (OSError, PackError):
+        return None
+
+
+def pack_folder(folder, sidecar='thumbs.json'):
+    '''Replace the loose page files of folder by a pack. Returns the
+    number of pages packed'''
+    pages = {}
+    names = []
+    for name in os.listdir(folder):
+        match = re_page_file.match(name)
+        if match:
+            with open(os.path.join(folder, name), 'rb') as f:
+                pages[int(match.group(1))] = f.read()
+            names.append(name)
+    if not pages:
+        return 0
+
+    meta = {}
+    sidecar_path = os.path.join(folder, sidecar)
+    if os.path.isfile(sidecar_path):
+        with open(sidecar_path) as f:
+            meta = json.load(f)
+        names.append(sidecar)
+
+    write_pack(os.path.join(folder, PACK_NAME), pages, meta)
+    for name in names:
+        os.remove(os.path.join(folder, name))
+    return len(pages)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+
+    folders = files = 0
+    for directory, _, filenames in os.walk(os.path.join(sys.argv[1], 'images')):
+        if PACK_NAME in filenames:
+            continue
+        try:
+            packed = pack_folder(directory)
+        except (OSError, ValueError) as ex:
+            logger.error("Error packing '{}': {}".format(directory, str(ex)))
+            continue
+        if packed:
+            folders += 1
+            files += packed
+
+    logger.info('{} pages packed in {} folders'.format(files, folders))
+    sys.exit(0)
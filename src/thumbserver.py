@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+'''
+Serves the page images of the documents with the layout of
+dir_processed, rendering on first request the pages that were not
+rendered at ingest (config['thumbnails']['mode'] = 'lazy'):
+
+    GET /<folder_img>/page-003.jpg[?dpi=150]
+    GET /<folder_img>/thumbs.json
+
+    python thumbserver.py
+'''
+from gevent import monkey
+monkey.patch_all()
+import os
+import re
+import sys
+import json
+from urllib.parse import unquote, parse_qs
+from gevent.pywsgi import WSGIServer
+import thumbnails
+from config import config
+from control import logger
+
+
+re_page = re.compile(r'^page-(\d+)\.(jpg|webp)$')
+
+CONTENT_TYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+MIN_DPI = 20
+MAX_DPI = 300
+
+
+def _reply(start_response, status, body=b'', content_type='text/plain'):
+    start_response(status, [('Content-Type', content_type),
+                            ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def make_app(dir_processed):
+
+    def app(environ, start_response):
+        if environ['REQUEST_METHOD'] != 'GET':
+            return _reply(start_response, '405 Method Not Allowed')
+
+        folder_img, name = os.path.split(unquote(environ['PATH_INFO']).lstrip('/'))
+        if '..' in folder_img.split('/'):
+            return _reply(start_response, '404 Not Found')
+
+        if name == thumbnails.SIDECAR:
+            info = thumbnails.read_sidecar(os.path.join(dir_processed, folder_img))
+            if info is None:
+                return _reply(start_response, '404 Not Found')
+            info.pop('file', None)
+            return _reply(start_response, '200 OK', json.dumps(info).encode(),
+                          'application/json')
+
+        # pages only exist in the format the renderer is configured with
+        fmt = thumbnails.get_renderer().fmt
+        match = re_page.match(name)
+        if not match or match.group(2) != thumbnails.FORMATS[fmt]:
+            return _reply(start_response, '404 Not Found')
+
+        dpi = None
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        if 'dpi' in query:
+            try:
+                dpi = int(query['dpi'][0])
+            except ValueError:
+                dpi = 0
+            if not MIN_DPI <= dpi <= MAX_DPI:
+                return _reply(start_response, '400 Bad Request',
+                              'dpi between {} and {}'.format(MIN_DPI, MAX_DPI).
+                              encode())
+
+        data = thumbnails.get_page(dir_processed, folder_img,
+                                   int(match.group(1)), dpi)
+        if data is None:
+            return _reply(start_response, '404 Not Found')
+        return _reply(start_response, '200 OK', data, CONTENT_TYPES[fmt])
+
+    return app
+
+
+if __name__ == '__main__':
+
+    config_app = config.get('app')
+    conf = config.get('thumbnails', {})
+    if not config_app or not config_app.get('dir_processed'):
+        logger.error('Missing: config > app > dir_processed')
+        sys.exit(1)
+
+    dir_processed = os.path.abspath(config_app['dir_processed'])
+    address = (conf.get('server_host', '127.0.0.1'), conf.get('server_port', 8090))
+
+    server = WSGIServer(address, make_app(dir_processed), log=None)
+    logger.info("Serving '{}' on {}:{}".format(dir_processed, *address))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+    sys.exit(0)
@@ -46,10 +46,9 @@ def query_yes_no(question, default=True):
                              "(or 'y' or 'n').\n")
 
 
-def hashfile(fpath):
+def hashfile(fpath, blocksize=1048576):
 
-    blocksize = 65536
-    hasher = sha256()
+    hasher = hashlib.sha256()
     with open(fpath, 'rb') as f:
         buf = f.read(blocksize)
         while len(buf) > 0:
@@ -178,6 +177,17 @@ def path_leaf(path):
     return tail or ntpath.basename(head)
 
 
+# bytes outside string.printable, deleted with bytes.translate
+NON_PRINTABLE_BYTES = bytes(b for b in range(256)
+                            if chr(b) not in string.printable)
+
+
+def remove_non_printable_bytes(data):
+    return data.translate(None, NON_PRINTABLE_BYTES)
+
+
 def remove_non_printable_chars(text):
-    return ''.join(list(filter(lambda x: x in set(string.printable), text)))
+    '''Keep only the chars in string.printable'''
+    data = text.encode('ascii', 'ignore')   # non ascii is never printable
+    return remove_non_printable_bytes(data).decode('ascii')
 
@@ -0,0 +1,194 @@
+from gevent import monkey
+monkey.patch_all()
+import gevent
+from gevent.socket import wait_read
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+from time import time
+from control import logger
+
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT = struct.Struct('iIII')   # wd, mask, cookie, len (name follows)
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+def inotify_available():
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        return hasattr(_get_libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+
+class Watcher():
+    '''
+    Recursive inotify watch of root. Files are reported once closed after
+    writing (or moved in) and quiet for settle_secs; every write restarts
+    the wait, so files still being copied are not reported half done.
+    New folders are reported as a whole once nothing happened inside them
+    for settle_secs.
+
+    callback(kind, path) runs in the watcher greenlets, kind being 'file',
+    'dir' or 'sweep' (the kernel queue overflowed and events were lost:
+    the whole tree has to be scanned).
+    '''
+
+    def __init__(self, root, callback, exclude=(), extension=None,
+                 settle_secs=2.0):
+        self.root = os.path.abspath(root)
+        self.callback = callback
+        self.exclude = set(os.path.abspath(path) for path in exclude)
+        self.extension = extension
+        self.settle_secs = settle_secs
+        self.fd = None
+        self.dirs = {}          # wd -> directory
+        self.pending = {}       # path -> [deadline, kind]
+        self.greenlets = []
+
+    def start(self):
+        libc = _get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, 'inotify_init1: {}'.format(os.strerror(err)))
+        self._watch_tree(self.root)
+        logger.info("Watching '{}' ({} folders)".format(self.root, len(self.dirs)))
+        self.greenlets = [gevent.spawn(self._read), gevent.spawn(self._flush)]
+        return self
+
+    def stop(self):
+        gevent.killall(self.greenlets)
+        self.greenlets = []
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.dirs = {}
+
+    def join(self):
+        gevent.joinall(self.greenlets)
+
+    def _add_watch(self, directory):
+        wd = _get_libc().inotify_add_watch(self.fd, os.fsencode(directory),
+                                           WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            logger.error("Cannot watch '{}': {}{}".format(
+                directory, os.strerror(err),
+                ' (raise fs.inotify.max_user_watches)'
+                if err == errno.ENOSPC else ''))
+            return
+        # a folder moved inside the tree keeps its wd, only the path changes
+        self.dirs[wd] = directory
+
+    def _watch_tree(self, top):
+        for directory, folders, _ in os.walk(top):
+            folders[:] = [f for f in folders
+                          if os.path.join(directory, f) not in self.exclude]
+            self._add_watch(directory)
+
+    def _read(self):
+        while True:
+            wait_read(self.fd)
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                self._event(wd, mask, os.fsdecode(name))
+
+    def _event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.error('inotify queue overflow, events lost')
+            self.pending[self.root] = [time(), 'sweep']
+            return
+        if mask & IN_IGNORED:       # folder deleted or moved out
+            self.dirs.pop(wd, None)
+            return
+
+        directory = self.dirs.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and path not in self.exclude:
+                self._watch_tree(path)
+                self._touch(path, 'dir')
+            return
+
+        if self.extension and not name.endswith(self.extension):
+            return
+        if mask & IN_MODIFY:
+            # still being written: only delays a file already seen
+            if self._owner(path) in self.pending:
+                self._touch(path, 'file')
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._touch(path, 'file')
+
+    def _owner(self, path):
+        '''The new folder path is reported with, or path itself'''
+        parent = os.path.dirname(path)
+        while parent.startswith(self.root) and parent != self.root:
+            if self.pending.get(parent, [0, None])[1] == 'dir':
+                return parent
+            parent = os.path.dirname(parent)
+        return path
+
+    def is_pending(self, path):
+        '''path, or the new folder it is in, is waiting to settle'''
+        owner = self._owner(os.path.abspath(path))
+        return owner != self.root and owner in self.pending
+
+    def _touch(self, path, kind):
+        owner = self._owner(path)
+        if owner != path:
+            kind = 'dir'
+        deadline = time() + self.settle_secs
+        if owner in self.pending and self.pending[owner][1] == 'sweep':
+            return
+        self.pending[owner] = [deadline, kind]
+
+    def _flush(self):
+        while True:
+            gevent.sleep(min(max(self.settle_secs / 2, 0.1), 1))
+            now = time()
+            due = sorted((path, kind) for path, (deadline, kind)
+                         in self.pending.items() if deadline <= now)
+            for path, kind in due:
+                del self.pending[path]
+                try:
+                    self.callback(kind, path)
+                except Exception as ex:
+                    logger.error("Error handling '{}': {}".format(path, str(ex)))